@@ -0,0 +1,39 @@
+// Read the columnar float32 exports written by birdcall_distribution/export.py.
+// The layout is a 4 byte magic string, the length of a json header as a
+// little-endian uint32, the header, and then every column as float32.
+
+export function parseColumnar(buffer) {
+  const view = new DataView(buffer);
+  const headerLength = view.getUint32(4, true);
+  const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+  const start = 8 + headerLength;
+  const columns = {};
+  header.columns.forEach((name, i) => {
+    columns[name] = new Float32Array(buffer, start + header.offsets[i], header.n_rows);
+  });
+  return { n_rows: header.n_rows, columns, metadata: header.metadata };
+}
+
+// Fetch a columnar file, using the gzip variant when the browser can
+// decompress it.
+export async function fetchColumnar(path, encodings = []) {
+  let res;
+  if (encodings.includes("gzip") && typeof DecompressionStream !== "undefined") {
+    res = await fetch(`${path}.gz`);
+    res = new Response(res.body.pipeThrough(new DecompressionStream("gzip")));
+  } else {
+    res = await fetch(path);
+  }
+  return parseColumnar(await res.arrayBuffer());
+}
+
+// Convert a columnar trace summary into the same records as trace_*.json.
+export function traceRecords({ n_rows, columns, metadata }) {
+  return Array.from({ length: n_rows }, (_, i) => {
+    const record = { index: metadata.index[i], method: metadata.method };
+    for (const [name, values] of Object.entries(columns)) {
+      record[name] = values[i];
+    }
+    return record;
+  });
+}
@@ -0,0 +1,43 @@
+"""The birdcall-distribution command line, with a subcommand per module in
+birdcall_distribution.commands.
+
+Only the module of the chosen subcommand is imported, so listing the commands
+or running a light one does not pay for pymc, arviz or matplotlib.
+"""
+import sys
+from argparse import REMAINDER, ArgumentParser
+from importlib import import_module
+
+# subcommand name to the module that implements it and a one line description
+COMMANDS = {
+    "earth-engine": ("earth_engine", "extract the covariates of a grid"),
+    "earth-engine-assets": ("earth_engine_assets", "plot the covariates of a grid"),
+    "model-assets": ("model_assets", "fit the models and write their assets"),
+    "compare-backends": ("compare_backends", "compare the NUTS backends"),
+    "generate-manifest": ("generate_manifest", "index the model assets"),
+    "bird-name-mapping": ("bird_name_mapping", "map species codes to names"),
+    "tiles": ("tiles", "serve or pre-render map tiles"),
+    "benchmark": ("benchmark", "benchmark the hot paths"),
+    "import-times": ("import_times", "check the import time budget"),
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = ArgumentParser(prog="birdcall-distribution")
+    subparsers = parser.add_subparsers(dest="command", metavar="command", required=True)
+    for name, (_, help) in COMMANDS.items():
+        # the arguments are parsed by the command itself
+        subparsers.add_parser(name, help=help, add_help=False).add_argument(
+            "args", nargs=REMAINDER
+        )
+    if not argv or argv[0] not in COMMANDS:
+        parser.parse_args(argv)
+    command = argv[0]
+    module = import_module(f"birdcall_distribution.commands.{COMMANDS[command][0]}")
+    sys.argv = [f"{parser.prog} {command}", *argv[1:]]
+    module.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""Benchmark the hot paths of the pipeline on the earth engine datasets.
+
+Recordings are generated with make_synthetic_recordings instead of reading the
+kaggle dataset. Each benchmark runs in a fresh process by default, so the peak
+resident memory is measured for that benchmark alone. Results are written as
+json, and can be compared against an earlier run with --compare.
+"""
+import io
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_INPUTS = [
+    "data/ee_v3_ca_1.parquet",
+    "data/ee_v3_western_us_2.parquet",
+    "data/ee_v3_americas_2.parquet",
+    "data/ee_v3_americas_5.parquet",
+]
+
+
+def _grid_meta(ee_path):
+    from birdcall_distribution.geo import get_grid_meta
+
+    row = pd.read_parquet(ee_path, columns=["region", "grid_size"]).iloc[0]
+    return get_grid_meta(row.region, int(row.grid_size))
+
+
+def bench_generate_grid(ee_path, recordings_path, args):
+    from birdcall_distribution.geo import generate_grid, generate_grid_adjacency_matrix
+
+    grid_meta = _grid_meta(ee_path)
+    size = (grid_meta.grid_size, grid_meta.grid_size)
+
+    def run():
+        grid = generate_grid(grid_meta.geometry, grid_meta.extent, size)
+        generate_grid_adjacency_matrix(grid)
+
+    return run
+
+
+def bench_add_lonlat_columns(ee_path, recordings_path, args):
+    from birdcall_distribution.geo import add_lonlat_columns
+
+    grid_meta = _grid_meta(ee_path)
+    df = pd.read_csv(recordings_path)
+    return lambda: add_lonlat_columns(df, grid_meta.grid)
+
+
+def bench_prepare_dataframe(ee_path, recordings_path, args):
+    from birdcall_distribution.data import prepare_dataframe
+
+    # load the grid outside of the timed function
+    _grid_meta(ee_path)
+    return lambda: prepare_dataframe(
+        ee_path, recordings_path, n_species=args.n_species, dense=False
+    )
+
+
+def _model_data(ee_path, recordings_path, args):
+    from birdcall_distribution.data import ModelData, get_scaler, prepare_dataframe
+
+    prep_df, W = prepare_dataframe(ee_path, recordings_path, n_species=args.n_species)
+    species = prep_df.groupby("primary_label").y.count().idxmax()
+    return ModelData.from_dataframe(
+        prep_df.fillna(0), W, scaler=get_scaler(ee_path)
+    ).subset([species])
+
+
+def bench_model_compile(ee_path, recordings_path, args):
+    from birdcall_distribution.commands.model_assets import make_model
+    from birdcall_distribution.sampling import compile_logp_dlogp
+
+    data = _model_data(ee_path, recordings_path, args)
+
+    def run():
+        with make_model(args.model, data, sparse=True):
+            compile_logp_dlogp()
+
+    return run
+
+
+def bench_model_sample(ee_path, recordings_path, args):
+    import arviz as az
+
+    from birdcall_distribution.commands.model_assets import make_model
+    from birdcall_distribution.sampling import compile_logp_dlogp, sample_posterior
+
+    data = _model_data(ee_path, recordings_path, args)
+    model = make_model(args.model, data, sparse=True)
+    with model:
+        logp_dlogp_func = compile_logp_dlogp()
+
+    def run():
+        with model:
+            trace = sample_posterior(
+                args.samples,
+                tune=args.tune,
+                cores=1,
+                chains=2,
+                random_seed=42,
+                logp_dlogp_func=logp_dlogp_func,
+            )
+        var_names = [rv.name for rv in model.free_RVs]
+        ess = az.ess(trace, var_names=var_names)
+        return dict(min_ess=min(float(ess[name].min()) for name in var_names))
+
+    return run
+
+
+def bench_plot_grid(ee_path, recordings_path, args):
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    from birdcall_distribution.plot import plot_grid
+
+    grid_meta = _grid_meta(ee_path)
+    rng = np.random.default_rng(0)
+    values = {key: rng.normal() for key in grid_meta.grid}
+
+    def run():
+        plot_grid(
+            grid_meta.geometry,
+            grid_meta.extent,
+            grid_meta.grid,
+            values=values,
+            vmin=min(values.values()),
+            vmax=max(values.values()),
+            draw_gridline=False,
+        )
+        plt.savefig(io.BytesIO(), format="png")
+        plt.close("all")
+
+    return run
+
+
+BENCHMARKS = {
+    "geo.generate_grid": bench_generate_grid,
+    "geo.add_lonlat_columns": bench_add_lonlat_columns,
+    "data.prepare_dataframe": bench_prepare_dataframe,
+    "model.compile": bench_model_compile,
+    "model.sample": bench_model_sample,
+    "plot.plot_grid": bench_plot_grid,
+}
+
+
+def _peak_rss_mb():
+    """Get the peak resident memory of this process in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, while macos reports bytes
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_benchmark(name, ee_path, recordings_path, args):
+    """Run a benchmark and get the wall time of each repeat, and the peak
+    resident memory of the process."""
+    run = BENCHMARKS[name](ee_path, recordings_path, args)
+    repeat = 1 if name == "model.sample" else args.repeat
+    seconds, metrics = [], {}
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = run()
+        seconds.append(time.perf_counter() - start)
+        # benchmarks can return extra metrics, like the effective sample size
+        if isinstance(value, dict):
+            metrics = value
+    result = dict(
+        name=name,
+        input=Path(ee_path).name,
+        seconds=seconds,
+        min_seconds=min(seconds),
+        median_seconds=float(np.median(seconds)),
+        peak_rss_mb=_peak_rss_mb(),
+        **metrics,
+    )
+    if "min_ess" in metrics:
+        result["ess_per_second"] = metrics["min_ess"] / seconds[-1]
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    """Print a table of results, with the ratio of the minimum wall time to a
+    baseline run if there is one."""
+    previous = {(r["name"], r["input"]): r for r in (baseline or [])}
+    print(
+        f"{'benchmark':<24} {'input':<28} {'min s':>9} {'rss mb':>8} {'ess/s':>8}"
+        + (f" {'vs base':>8}" if baseline else "")
+    )
+    for r in results:
+        ess = f"{r['ess_per_second']:>8.1f}" if "ess_per_second" in r else " " * 8
+        line = (
+            f"{r['name']:<24} {r['input']:<28} {r['min_seconds']:>9.3f} "
+            f"{r['peak_rss_mb']:>8.0f} {ess}"
+        )
+        base = previous.get((r["name"], r["input"]))
+        if base:
+            line += f" {r['min_seconds'] / base['min_seconds']:>7.2f}x"
+        print(line)
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument("inputs", type=str, nargs="*", default=DEFAULT_INPUTS)
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--n-recordings", type=int, default=10000)
+    parser.add_argument("--n-species", type=int, default=10)
+    parser.add_argument("--model", type=str, default="intercept_car")
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument("--tune", type=int, default=500)
+    parser.add_argument(
+        "--no-isolate",
+        action="store_true",
+        help="run in this process, so the peak memory is shared by benchmarks",
+    )
+    parser.add_argument(
+        "--output", type=str, default="benchmarks", help="directory for the results"
+    )
+    parser.add_argument("--compare", type=str, help="results of a previous run")
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmarks on each input, and write the results as json."""
+    from birdcall_distribution.data import make_synthetic_recordings
+
+    args = parse_args()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for ee_path in args.inputs:
+            row = pd.read_parquet(ee_path, columns=["region", "grid_size"]).iloc[0]
+            recordings_path = Path(tmp) / f"{Path(ee_path).stem}_recordings.csv"
+            make_synthetic_recordings(
+                row.region, int(row.grid_size), n_recordings=args.n_recordings
+            ).to_csv(recordings_path, index=False)
+            for name in args.benchmarks:
+                if args.no_isolate:
+                    result = run_benchmark(name, ee_path, recordings_path, args)
+                else:
+                    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as ex:
+                        result = ex.submit(
+                            run_benchmark, name, ee_path, recordings_path, args
+                        ).result()
+                print(json.dumps(result))
+                results.append(result)
+
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    print_results(results, baseline and baseline["results"])
+
+    created = datetime.now(timezone.utc)
+    commit = _git_commit()
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    path = output / f"{created:%Y%m%dT%H%M%S}_{commit or 'unknown'}.json"
+    path.write_text(
+        json.dumps(
+            dict(
+                created=created.isoformat(),
+                commit=commit,
+                python=platform.python_version(),
+                platform=platform.platform(),
+                options=vars(args),
+                results=results,
+            ),
+            indent=2,
+        )
+    )
+    print(f"Wrote results to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,8 @@
 import json
 from argparse import ArgumentParser
-from functools import partial
 from pathlib import Path
 
-import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
-import tqdm
-
-from birdcall_distribution.geo import get_grid_meta, get_modis_land_cover_name
-from birdcall_distribution.plot import dataframe_color_getter, plot_grid
+from birdcall_distribution.taxonomy import add_taxonomy_args, write_species_mapping
 
 
 def parse_args():
@@ -17,29 +10,32 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument("input", type=str, help="Path to the input dataset")
     parser.add_argument("output", type=str, help="Path to the output directory")
+    add_taxonomy_args(parser)
     return parser.parse_args()
 
 
 def main():
+    """Map the species in the manifest to their common names. Names that are
+    already in the mapping are kept, so the taxonomy is only loaded when there
+    are new species."""
     args = parse_args()
     input_path = Path(args.input)
     output_path = Path(args.output)
 
-    taxonomy_df = pd.read_csv(
-        "https://storage.googleapis.com/birdclef-eda-f22/data/raw/birdclef-2022/eBird_Taxonomy_v2021.csv"
-    )
-    taxonomy_df.columns = taxonomy_df.columns.str.lower()
-    species_mapper = taxonomy_df.set_index("species_code")["primary_com_name"].to_dict()
-
     # read manifest file
     with open(input_path / "manifest.json") as f:
         manifest = json.load(f)
 
     # get all the set of all species
     species = set([row["primary_label"] for row in manifest])
-    mapper_subset = {k: v for k, v in species_mapper.items() if k in species}
-    with open(output_path / "species_mapping.json", "w") as f:
-        json.dump(mapper_subset, f, indent=2)
+    added = write_species_mapping(
+        output_path / "species_mapping.json",
+        species,
+        version=args.taxonomy_version,
+        source=args.taxonomy,
+        offline=args.offline,
+    )
+    print(f"Added {len(added)} species to the mapping")
 
 
 if __name__ == "__main__":
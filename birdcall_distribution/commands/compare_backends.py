@@ -0,0 +1,95 @@
+import json
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+
+from birdcall_distribution.commands.model_assets import MODELS, make_model
+from birdcall_distribution.data import ModelData, get_scaler, prepare_dataframe
+from birdcall_distribution.sampling import BACKENDS, sample_posterior
+from birdcall_distribution.utils import lazy_import
+
+az = lazy_import("arviz")
+
+
+def compare(
+    model_type, data, backend, samples=1000, tune=1000, cores=4, random_seed=42
+):
+    """Time sampling a model with a backend, and get the effective sample size
+    per second of the slowest mixing free variable."""
+    with make_model(model_type, data, sparse=True) as model:
+        start = time.time()
+        trace = sample_posterior(
+            samples, tune=tune, cores=cores, backend=backend, random_seed=random_seed
+        )
+        elapsed = time.time() - start
+    var_names = [rv.name for rv in model.free_RVs]
+    ess = az.ess(trace, var_names=var_names)
+    min_ess = min(float(ess[name].min()) for name in var_names)
+    return dict(
+        backend=backend,
+        seconds=elapsed,
+        min_ess=min_ess,
+        ess_per_second=min_ess / elapsed,
+    )
+
+
+def main():
+    """Compare the wall time and effective samples per second of the NUTS
+    backends on the earth engine datasets."""
+    parser = ArgumentParser()
+    parser.add_argument(
+        "inputs",
+        type=str,
+        nargs="*",
+        default=["data/ee_v3_ca_1.parquet", "data/ee_v3_americas_5.parquet"],
+    )
+    parser.add_argument("--model", type=str, default="intercept_car", choices=MODELS)
+    parser.add_argument(
+        "--train_metadata",
+        type=str,
+        default="data/raw/birdclef-2022/train_metadata.csv",
+    )
+    parser.add_argument("--backends", type=str, nargs="+", default=BACKENDS)
+    parser.add_argument("--samples", type=int, default=1000)
+    parser.add_argument("--tune", type=int, default=1000)
+    parser.add_argument("--cores", type=int, default=4)
+    parser.add_argument("--output", type=str, help="Path to write results as json")
+    args = parser.parse_args()
+
+    results = []
+    for path in args.inputs:
+        prep_df, W = prepare_dataframe(path, args.train_metadata, n_species=None)
+        prep_df = prep_df[prep_df.index.notnull()]
+        species = prep_df.groupby("primary_label").y.count().idxmax()
+        data = ModelData.from_dataframe(
+            prep_df.fillna(0), W, scaler=get_scaler(path)
+        ).subset([species])
+        for backend in args.backends:
+            try:
+                result = compare(
+                    args.model,
+                    data,
+                    backend,
+                    samples=args.samples,
+                    tune=args.tune,
+                    cores=args.cores,
+                )
+            except ImportError as e:
+                print(f"Skipping {backend}, it is not installed: {e}")
+                continue
+            result.update(input=Path(path).name, model=args.model, species=species)
+            print(json.dumps(result))
+            results.append(result)
+
+    print(f"{'input':<28} {'backend':<10} {'seconds':>10} {'ess/s':>10}")
+    for r in results:
+        print(
+            f"{r['input']:<28} {r['backend']:<10} "
+            f"{r['seconds']:>10.1f} {r['ess_per_second']:>10.2f}"
+        )
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,100 +1,14 @@
 from argparse import ArgumentParser
-from functools import partial
-from multiprocessing import Pool
 
-import ee
-import pandas as pd
-from shapely.geometry import mapping
-from tqdm.auto import tqdm
-
-from birdcall_distribution.geo import (
-    AMERICAS_EXTENT,
-    CA_EXTENT,
-    WESTERN_US_EXTENT,
-    generate_grid,
-    get_americas_geometry,
-    get_california_geometry,
-    get_western_us_geometry,
+from birdcall_distribution.covariates import (
+    COVARIATE_CACHE_DIR,
+    CovariateCache,
+    EarthEngineBackend,
+    LocalRasterBackend,
+    run_covariate_job,
 )
-
-
-def t_modis_to_celsius(t_modis):
-    """Converts MODIS LST units to degrees Celsius."""
-    if t_modis is None:
-        return None
-    t_celsius = 0.02 * t_modis - 273.15
-    return t_celsius
-
-
-def get_stats(grid, key, start_ds="2019-01-01", end_ds="2022-01-01", scale=1000):
-    """Get statistics for population, elevation, temperature, and land cover."""
-
-    # NOTE: in every function call? This seems like a waste of network requests
-    ee.Initialize()
-
-    geojson = mapping(grid[key])
-    poi = ee.Geometry.Polygon(geojson["coordinates"])
-
-    # population
-    population_density = (
-        ee.ImageCollection("CIESIN/GPWv411/GPW_Population_Density")
-        .select("population_density")
-        .limit(1, "system:time_start", False)
-        .first()
-        .reduceRegion(ee.Reducer.sum(), poi, scale)
-        .getInfo()
-    )
-
-    # Import the USGS ground elevation image.
-    elevation = (
-        ee.Image("USGS/SRTMGL1_003")
-        .select("elevation")
-        .reduceRegion(
-            ee.Reducer.percentile([5, 50, 95]),
-            poi,
-            scale=scale,
-        )
-        .getInfo()
-    )
-
-    # Import the MODIS land surface temperature collection.
-    # temperature day and night, with quality control bands
-    # we need to filter it first
-    surface_temp = (
-        ee.ImageCollection("MODIS/006/MOD11A1")
-        .select("LST_Day_1km", "LST_Night_1km")
-        .filterDate(start_ds, end_ds)
-        .mean()
-        .reduceRegion(
-            ee.Reducer.percentile([5, 50, 95]),
-            poi,
-            scale=scale,
-        )
-        .getInfo()
-    )
-
-    # Import the MODIS land cover collection.
-    # https://developers.google.com/earth-engine/datasets/catalog/MODIS_006_MCD12Q1#bands
-    land_cover = (
-        ee.ImageCollection("MODIS/006/MCD12Q1")
-        .first()
-        .sample(poi, scale)
-        .aggregate_histogram("LC_Type1")
-        .getInfo()
-    )
-
-    # count the total number of pixels, do not smooth to account for differences
-    keys = list(range(1, 18))
-    land_cover = {f"land_cover_{k:02d}": land_cover.get(str(k), 0) for k in keys}
-
-    return dict(
-        name=key,
-        **population_density,
-        **elevation,
-        # map over values and convert to celsius
-        **{k: t_modis_to_celsius(v) for k, v in surface_temp.items()},
-        **land_cover,
-    )
+from birdcall_distribution.geo import get_grid_meta
+from birdcall_distribution.profiling import add_profile_args, profile_run, span
 
 
 def main():
@@ -104,37 +18,54 @@ def main():
     parser.add_argument("grid_size", type=int)
     parser.add_argument("output", type=str)
     parser.add_argument("--parallelism", type=int, default=8)
+    parser.add_argument(
+        "--chunk-size", type=int, default=100, help="number of cells per request"
+    )
+    parser.add_argument("--cache-dir", type=str, default=str(COVARIATE_CACHE_DIR))
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=4,
+        help="maximum number of concurrent requests per dataset",
+    )
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument(
+        "--backoff", type=float, default=2.0, help="initial retry delay in seconds"
+    )
+    parser.add_argument(
+        "--local-rasters",
+        type=str,
+        help="directory of rasters to use instead of earth engine",
+    )
+    add_profile_args(parser)
     args = parser.parse_args()
+    with profile_run(args.profile, trace_memory=args.profile_memory):
+        run(args)
 
-    if args.region == "ca":
-        geometry = get_california_geometry()
-        extent = CA_EXTENT
-    elif args.region == "western_us":
-        geometry = get_western_us_geometry()
-        extent = WESTERN_US_EXTENT
-    elif args.region == "americas":
-        geometry = get_americas_geometry()
-        extent = AMERICAS_EXTENT
-    else:
-        raise ValueError(f"Invalid region: {args.region}")
-
-    grid = generate_grid(geometry, extent, (args.grid_size, args.grid_size))
-    stats = []
 
-    keys = list(grid.keys())
-
-    with Pool(args.parallelism) as p:
-        stats = list(
-            tqdm(
-                p.imap(partial(get_stats, grid), keys),
-                total=len(keys),
-            )
-        )
-    df = pd.DataFrame(stats)
-    df.insert(1, "grid_size", args.grid_size)
-    df.insert(1, "region", args.region)
+def run(args):
+    with span("geo.get_grid_meta"):
+        grid = get_grid_meta(args.region, args.grid_size).grid
+    backend = (
+        LocalRasterBackend(args.local_rasters)
+        if args.local_rasters
+        else EarthEngineBackend()
+    )
+    df = run_covariate_job(
+        grid,
+        backend,
+        args.output,
+        cache=None if args.no_cache else CovariateCache(args.cache_dir),
+        region=args.region,
+        grid_size=args.grid_size,
+        chunk_size=args.chunk_size,
+        parallelism=args.parallelism,
+        max_concurrent=args.max_concurrent,
+        max_retries=args.max_retries,
+        backoff=args.backoff,
+    )
     print(df.head())
-    df.to_parquet(args.output)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,17 @@
 import json
+import os
 from argparse import ArgumentParser
-from functools import partial
 from pathlib import Path
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import tqdm
 
-from birdcall_distribution.geo import get_grid_meta, get_modis_land_cover_name
-from birdcall_distribution.plot import dataframe_color_getter, plot_grid
+from birdcall_distribution.geo import get_modis_land_cover_name
+from birdcall_distribution.profiling import add_profile_args, profile_run, span
+from birdcall_distribution.utils import lazy_import
+
+# matplotlib and cartopy are imported when the first plot is rendered
+plot = lazy_import("birdcall_distribution.plot")
 
 
 def parse_args():
@@ -17,67 +19,81 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument("input", type=str, help="Path to the input dataset")
     parser.add_argument("output", type=str, help="Path to the output directory")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes to render plots with",
+    )
+    add_profile_args(parser)
     return parser.parse_args()
 
 
-def plot_features(df, output_path):
-    """Plot all of the numerical features of the dataset using the plot_species function."""
+def feature_plot_jobs(df, output_path):
+    """Plot jobs for all of the numerical features of the dataset, on a linear
+    and log scale."""
     region = df.region.unique()[0]
     grid_size = df.grid_size.unique()[0]
-    grid_meta = get_grid_meta(region, grid_size)
 
     props = df.columns[3:]
-
-    for prop in tqdm.tqdm(props):
-        plot_grid(
-            grid_meta.geometry,
-            grid_meta.extent,
-            grid_meta.grid,
-            color_callback=partial(dataframe_color_getter, df, "name", prop),
-            vmin=df[prop].min(),
-            vmax=df[prop].max(),
-            draw_gridline=False,
-            figsize=(5, 4.5),
-        )
+    jobs = []
+    for prop in props:
         name = (
             f"{prop}: {get_modis_land_cover_name(prop)}"
             if "land_cover" in prop
             else prop
         )
-        plt.tight_layout()
-        plt.title(name)
-        plt.savefig(f"{output_path}/{prop}.png")
-        plt.close()
+        jobs.append(
+            plot.PlotJob(
+                f"{output_path}/{prop}.png",
+                region,
+                grid_size,
+                values=df.set_index("name")[prop].to_dict(),
+                title=name,
+                vmin=df[prop].min(),
+                vmax=df[prop].max(),
+                figsize=(5, 4.5),
+            )
+        )
 
     # plot log scaled
-    for prop in tqdm.tqdm(props):
-        df["log_" + prop] = df[prop].apply(lambda x: np.log(x + 1))
+    for prop in props:
+        log_values = np.log(df[prop] + 1)
         prop = "log_" + prop
-        plot_grid(
-            grid_meta.geometry,
-            grid_meta.extent,
-            grid_meta.grid,
-            color_callback=partial(dataframe_color_getter, df, "name", prop),
-            vmin=df[prop].min(),
-            vmax=df[prop].max(),
-            draw_gridline=False,
-            figsize=(5, 4.5),
-        )
         name = (
             f"log {prop}: {get_modis_land_cover_name(prop)}"
             if "land_cover" in prop
             else prop
         )
-        plt.tight_layout()
-        plt.title(name)
-        plt.savefig(f"{output_path}/{prop}.png")
-        plt.close()
+        jobs.append(
+            plot.PlotJob(
+                f"{output_path}/{prop}.png",
+                region,
+                grid_size,
+                values=dict(zip(df.name, log_values)),
+                title=name,
+                vmin=log_values.min(),
+                vmax=log_values.max(),
+                figsize=(5, 4.5),
+            )
+        )
+    return props, jobs
+
 
+def plot_features(df, output_path, processes=1):
+    """Plot all of the numerical features of the dataset."""
+    props, jobs = feature_plot_jobs(df, output_path)
+    plot.render_plot_jobs(jobs, processes=processes, progress=True)
     return props
 
 
 def main():
     args = parse_args()
+    with profile_run(args.profile, trace_memory=args.profile_memory):
+        run(args)
+
+
+def run(args):
     input_path = Path(args.input)
 
     # search for all parquet datasets that contain v3 in them
@@ -86,6 +102,7 @@ def main():
 
     maps = []
     props = []
+    jobs = []
     # generate a plot for each of the features
     for parquet_file in list(reversed(parquet_files)):
         df = pd.read_parquet(parquet_file)
@@ -94,8 +111,13 @@ def main():
         maps.append(dict(region=region, grid_size=grid_size))
         output_path = Path(args.output) / f"{region}_{grid_size}"
         output_path.mkdir(exist_ok=True, parents=True)
-        print("Plotting features for", parquet_file)
-        props = plot_features(df, output_path)
+        props, file_jobs = feature_plot_jobs(df, output_path)
+        jobs += file_jobs
+
+    # render the plots for all of the datasets at once
+    print(f"Plotting {len(jobs)} features for {len(parquet_files)} datasets")
+    with span("plot.render", n_plots=len(jobs)):
+        plot.render_plot_jobs(jobs, processes=args.processes, progress=True)
 
     # output a manifest
     (
@@ -1,61 +1,207 @@
 """Walk through the data directory to create a list of all paths.
 
 This makes it possible for the client application to find all the images and
-data.
+data. The entry for each directory is cached in an index along with the
+modification times of the directory and its metadata files, so a rerun only
+reads the directories that changed since the last run. With --species-mapping,
+the common names of any new species are added to the species mapping for the
+app.
 """
+import hashlib
 import json
+import os
 from argparse import ArgumentParser
 from pathlib import Path
 
+from birdcall_distribution.export import ENCODINGS
+from birdcall_distribution.taxonomy import add_taxonomy_args, write_species_mapping
+
+MANIFEST_INDEX_VERSION = 1
+MANIFEST_CACHE_DIR = Path(
+    os.environ.get(
+        "BIRDCALL_MANIFEST_CACHE",
+        Path.home() / ".cache" / "birdcall_distribution" / "manifest",
+    )
+)
+
 
 def parse_args():
     """Parse the location of the root directory and the manifest output path."""
     parser = ArgumentParser()
     parser.add_argument("root", type=str, help="Path to the root directory")
     parser.add_argument("output", type=str, help="Path to the output manifest")
+    parser.add_argument(
+        "--index", type=str, help="Path to the cached index of the root directory"
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="ignore the cached index"
+    )
+    add_taxonomy_args(parser)
+    parser.add_argument(
+        "--species-mapping",
+        type=str,
+        help="Path to a species mapping to update with any new species",
+    )
     return parser.parse_args()
 
 
+def index_path(root, cache_dir=None):
+    """Get the path of the cached index for a root directory."""
+    key = hashlib.sha256(str(Path(root).resolve()).encode()).hexdigest()[:16]
+    return Path(cache_dir or MANIFEST_CACHE_DIR) / f"{key}.json"
+
+
+def columnar_assets(path, label):
+    """List the columnar exports for a species, and the precompressed encodings
+    that are available for all of them."""
+    names = {"trace": f"trace_{label}.bin", "ppc": f"ppc_{label}.bin"}
+    if not all((path / name).exists() for name in names.values()):
+        return None
+    encodings = [
+        encoding
+        for encoding, suffix in ENCODINGS.items()
+        if all((path / f"{name}{suffix}").exists() for name in names.values())
+    ]
+    return dict(**names, encodings=encodings)
+
+
+def metadata_files(filenames):
+    """Get the files in a directory that describe a set of model assets, or
+    None if the directory does not contain a trace and ppc json file."""
+    names = sorted(
+        name
+        for name in filenames
+        if name.endswith(".json") and name.startswith(("trace", "ppc", "meta_"))
+    )
+    if not (
+        any(name.startswith("trace") for name in names)
+        and any(name.startswith("ppc") for name in names)
+    ):
+        return None
+    return names
+
+
+def read_metadata(path, names):
+    """Read the metadata for the assets in a directory from the sidecar written
+    by model_assets, or from the ppc and trace files for older assets."""
+    sidecar = [name for name in names if name.startswith("meta_")]
+    if sidecar:
+        return json.loads((path / sidecar[0]).read_text())
+
+    # based on the data in the ppc file, figure out what metadata to
+    # associate with the current path
+    ppc_name = [name for name in names if name.startswith("ppc")][0]
+    row = json.loads((path / ppc_name).read_text())[0]
+    # older traces were always sampled with nuts
+    trace_name = [name for name in names if name.startswith("trace")][0]
+    trace = json.loads((path / trace_name).read_text())
+    return dict(
+        primary_label=row["primary_label"],
+        region=row["region"],
+        grid_size=row["grid_size"],
+        method=trace[0].get("method", "nuts") if trace else "nuts",
+    )
+
+
+def manifest_item(root, path, names):
+    """Create the manifest entry for a directory of model assets."""
+    metadata = read_metadata(path, names)
+    label = metadata["primary_label"]
+    item = {
+        "path": path.relative_to(root).as_posix(),
+        "images": {
+            "observed_linear": f"observed_{label}.png",
+            "observed_log": f"observed_{label}_log.png",
+            "ppc_linear": f"ppc_{label}_linear.png",
+            "ppc_log": f"ppc_{label}_log.png",
+        },
+        "traces": {
+            "trace": f"trace_{label}.json",
+            "ppc": f"ppc_{label}.json",
+        },
+        "primary_label": label,
+        "region": metadata["region"],
+        "grid_size": metadata["grid_size"],
+        "model": path.parts[-4],
+        "fit": metadata.get("method", "nuts"),
+    }
+    columnar = columnar_assets(path, label)
+    if columnar:
+        item["columnar"] = columnar
+    if (path / "tiles" / "tiles.json").exists():
+        item["tiles"] = "tiles/tiles.json"
+    return item
+
+
+def build_manifest(root, index=None):
+    """Walk through the root directory and generate a manifest of all model
+    assets. Entries in the index are reused if the modification times of the
+    directory and its metadata files have not changed. Returns the manifest,
+    the updated index and the number of directories that were read."""
+    root = Path(root)
+    index = index or {}
+    manifest, updated, n_read = [], {}, 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        # there's no need to walk through the pre-rendered tiles
+        dirnames[:] = [name for name in dirnames if name != "tiles"]
+        names = metadata_files(filenames)
+        if names is None:
+            continue
+        path = Path(dirpath)
+        key = path.relative_to(root).as_posix()
+        # files written in place do not change the mtime of the directory
+        signature = [path.stat().st_mtime_ns] + [
+            (path / name).stat().st_mtime_ns for name in names
+        ]
+        entry = index.get(key)
+        if entry is None or entry["signature"] != signature:
+            entry = dict(signature=signature, item=manifest_item(root, path, names))
+            n_read += 1
+        updated[key] = entry
+        manifest.append(entry["item"])
+    manifest.sort(key=lambda item: item["path"])
+    return manifest, updated, n_read
+
+
+def load_index(path):
+    """Load a cached index, or an empty one if it is missing or outdated."""
+    path = Path(path)
+    if not path.exists():
+        return {}
+    cached = json.loads(path.read_text())
+    if cached.get("version") != MANIFEST_INDEX_VERSION:
+        return {}
+    return cached["entries"]
+
+
+def write_json(path, data, **kwargs):
+    """Write json to a temporary file and move it into place, so readers never
+    see a partially written file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.parent / f".{path.name}.{os.getpid()}.tmp"
+    tmp_path.write_text(json.dumps(data, **kwargs))
+    os.replace(tmp_path, path)
+
+
 def main():
     """Walk through the root directory and generate a manifest of all files."""
     args = parse_args()
-    root = Path(args.root)
-    output = Path(args.output)
-    manifest = []
-    for path in root.glob("**/*"):
-        # find a directory that contains a trace and ppc json file.
-        if path.is_file() or not (
-            len(list(path.glob("trace*.json"))) > 0
-            and len(list(path.glob("ppc*.json"))) > 0
-        ):
-            continue
-
-        # based on the data in the ppc file, figure out what metadata to
-        # associate with the current path
-        ppc_path = list(path.glob("ppc*.json"))[0]
-        data = json.loads(ppc_path.read_text())
-        row = data[0]
-        label = row["primary_label"]
-        item = {
-            "path": path.relative_to(root).as_posix(),
-            "images": {
-                "observed_linear": f"observed_{label}.png",
-                "observed_log": f"observed_{label}_log.png",
-                "ppc_linear": f"ppc_{label}_linear.png",
-                "ppc_log": f"ppc_{label}_log.png",
-            },
-            "traces": {
-                "trace": f"trace_{label}.json",
-                "ppc": f"ppc_{label}.json",
-            },
-            "primary_label": row["primary_label"],
-            "region": row["region"],
-            "grid_size": row["grid_size"],
-            "model": path.parts[-4],
-        }
-        manifest.append(item)
-
-    Path(output).write_text(json.dumps(manifest, indent=2))
+    index_file = Path(args.index) if args.index else index_path(args.root)
+    index = {} if args.rebuild else load_index(index_file)
+    manifest, index, n_read = build_manifest(args.root, index)
+    write_json(args.output, manifest, indent=2)
+    write_json(index_file, dict(version=MANIFEST_INDEX_VERSION, entries=index))
+    print(f"Wrote {len(manifest)} entries, read {n_read} changed directories")
+    if args.species_mapping:
+        added = write_species_mapping(
+            args.species_mapping,
+            {item["primary_label"] for item in manifest},
+            version=args.taxonomy_version,
+            source=args.taxonomy,
+            offline=args.offline,
+        )
+        print(f"Added {len(added)} species to {args.species_mapping}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+"""Check the import time of the commands against a budget.
+
+Each module is imported in a fresh interpreter with `python -X importtime`,
+which reports the cumulative time to import every module, and the median over
+several imports is compared to the budget. A module fails the check if it
+takes longer than its budget, or if it imports a package that it should only
+load when it is used.
+"""
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser
+
+# packages that take seconds to import, and are only loaded when used
+HEAVY = ["pymc", "aesara", "arviz", "matplotlib", "cartopy", "sklearn", "jax"]
+LIGHT = HEAVY + ["numpy", "pandas", "scipy", "shapely"]
+
+# module to the budget in seconds and the packages it must not import. The
+# commands that read data need numpy and pandas before they parse arguments,
+# but none of them should need pymc or matplotlib. The budgets are several
+# times a warm import on a laptop, so they catch a heavy dependency being
+# imported eagerly rather than small regressions, while the packages are
+# checked exactly.
+BUDGETS = {
+    "birdcall_distribution.cli": (0.1, LIGHT),
+    "birdcall_distribution.commands.generate_manifest": (0.25, LIGHT),
+    "birdcall_distribution.commands.bird_name_mapping": (0.25, LIGHT),
+    "birdcall_distribution.commands.tiles": (0.5, LIGHT),
+    "birdcall_distribution.commands.model_assets": (2.5, HEAVY),
+    "birdcall_distribution.commands.compare_backends": (2.5, HEAVY),
+    "birdcall_distribution.commands.earth_engine": (2.5, HEAVY),
+    "birdcall_distribution.commands.earth_engine_assets": (2.5, HEAVY),
+    "birdcall_distribution.commands.benchmark": (2.5, HEAVY),
+}
+
+
+def import_times(module):
+    """Import a module in a new interpreter, and get the cumulative import time
+    in seconds of every module it imported."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def check_module(module, budget, forbidden, repeat=5):
+    """Get the median of several import times of a module, and the forbidden
+    packages it imports. The first import is not counted, since it may compile
+    the bytecode and read the files from disk."""
+    times = import_times(module)
+    seconds = statistics.median(
+        import_times(module)[module] for _ in range(max(repeat, 1))
+    )
+    imported = sorted({name.split(".")[0] for name in times} & set(forbidden))
+    return dict(
+        module=module,
+        seconds=seconds,
+        budget=budget,
+        imported=imported,
+        ok=seconds <= budget and not imported,
+    )
+
+
+def check_budget(module, factor=1.0, repeat=5):
+    """Check a module against its budget, scaled by a factor for slow machines.
+    Modules without a budget are only checked for heavy imports."""
+    budget, forbidden = BUDGETS.get(module, (float("inf"), HEAVY))
+    return check_module(module, budget * factor, forbidden, repeat=repeat)
+
+
+def main():
+    """Check the import time of each command, and exit with an error if any of
+    them are over budget."""
+    parser = ArgumentParser()
+    parser.add_argument("modules", type=str, nargs="*", default=list(BUDGETS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--factor", type=float, default=1.0, help="scale the budgets for slow machines"
+    )
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<52} {'seconds':>8} {'budget':>8}  heavy imports")
+    for module in args.modules:
+        result = check_budget(module, factor=args.factor, repeat=args.repeat)
+        failed |= not result["ok"]
+        print(
+            f"{module:<52} {result['seconds']:>8.3f} {result['budget']:>8.2f}  "
+            f"{', '.join(result['imported'])}{'' if result['ok'] else '  FAIL'}"
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
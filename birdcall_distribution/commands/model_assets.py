@@ -1,106 +1,371 @@
+import json
+import os
+import time
+import traceback
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import partial
 from pathlib import Path
 
-import arviz as az
-import matplotlib.pyplot as plt
 import numpy as np
-import pymc as pm
 import tqdm
 
-from birdcall_distribution import model
-from birdcall_distribution.data import prepare_dataframe
-from birdcall_distribution.plot import plot_ppc_species, plot_species
+from birdcall_distribution.data import (
+    FEATURE_SETS,
+    ModelData,
+    get_scaler,
+    prepare_dataframe,
+)
+from birdcall_distribution.export import write_columnar
+from birdcall_distribution.profiling import add_profile_args, profile_run, span
+from birdcall_distribution.sampling import (
+    BACKENDS,
+    FIT_METHODS,
+    compile_logp_dlogp,
+    fit_posterior,
+    posterior_predictive_summary,
+)
+from birdcall_distribution.utils import lazy_import
 
+# pymc, arviz and matplotlib are imported when they are first used, so the
+# command can parse its arguments without them
+az = lazy_import("arviz")
+pm = lazy_import("pymc")
+model = lazy_import("birdcall_distribution.model")
+plot = lazy_import("birdcall_distribution.plot")
 
-def generate_assets(model_type, df, W, output_path, species, cores=4, samples=1000):
-    """Generate assets for a given species"""
-    path = Path(output_path) / species
-    path.mkdir(parents=True, exist_ok=True)
+# the builders are looked up by name in birdcall_distribution.model
+MODELS = {
+    "intercept_car": "make_pooled_intercept_car_model",
+    "intercept_covariate_car": "make_pooled_intercept_pooled_covariate_car_model",
+}
+# models that fit all of the species at once, with the same priors per species
+BATCHED_MODELS = {
+    "intercept_car": "make_unpooled_intercept_car_model",
+    "intercept_covariate_car": "make_unpooled_intercept_unpooled_covariate_car_model",
+}
 
-    # plot the data
-    sub_df = df[df.primary_label == species].copy().fillna(0)
 
-    model_func = {
-        "intercept_car": model.make_pooled_intercept_car_model,
-        "intercept_covariate_car": model.make_pooled_intercept_pooled_covariate_car_model,
-    }[model_type]
+def make_model(model_type, data, batched=False, **kwargs):
+    """Build a model by its name in MODELS, or in BATCHED_MODELS if batched."""
+    builders = BATCHED_MODELS if batched else MODELS
+    return getattr(model, builders[model_type])(data, **kwargs)
 
-    with model_func(sub_df, W):
-        trace = pm.sample(samples, cores=cores)
-        ppc = pm.sample_posterior_predictive(trace)
 
-    # also save the trace
-    summary = az.summary(trace, kind="stats", hdi_prob=0.95)
-    summary.reset_index().to_json(
-        f"{path}/trace_{species}.json",
-        orient="records",
+# models that have been built and compiled in this process
+_compiled_models = {}
+
+
+def compiled_model(model_type, species_data, sparse=False, compile_nuts=True):
+    """Build and compile a per-species model once per process. Every species
+    has an observation per cell of the same grid, so later species reuse the
+    model and only swap in their counts with pm.set_data. The model keeps the
+    species label of the first species, which the per-species models do not
+    use. The log-density and gradient for the pymc NUTS sampler are compiled
+    with the model if compile_nuts is set."""
+    key = (
+        model_type,
+        sparse,
+        compile_nuts,
+        species_data.cells.tobytes(),
+        tuple(species_data.features),
     )
+    if key not in _compiled_models:
+        with span("model.compile", model=model_type), make_model(
+            model_type, species_data, sparse=sparse
+        ) as species_model:
+            logp_dlogp_func = compile_logp_dlogp() if compile_nuts else None
+        _compiled_models[key] = (species_model, logp_dlogp_func)
+    return _compiled_models[key]
+
+
+def generate_assets(
+    model_type,
+    df,
+    data,
+    output_path,
+    species,
+    cores=4,
+    samples=1000,
+    sparse=False,
+    plot_processes=1,
+    backend="pymc",
+    fit="nuts",
+):
+    """Generate assets for a given species. The rows of the dataframe are in
+    the same order as the observations of the model data."""
+    sub_df = df[df.primary_label == species].copy().fillna(0)
+
+    species_data = data.subset([species])
+    species_model, logp_dlogp_func = compiled_model(
+        model_type,
+        species_data,
+        sparse,
+        compile_nuts=backend == "pymc" and fit == "nuts",
+    )
+    with species_model:
+        pm.set_data({"y_observed": species_data.y})
+        with span("model.fit", method=fit, backend=backend):
+            trace = fit_posterior(
+                samples,
+                method=fit,
+                cores=cores,
+                backend=backend,
+                logp_dlogp_func=logp_dlogp_func,
+            )
+        with span("model.ppc"):
+            ppc_summary = posterior_predictive_summary(trace)
+
+    write_assets(
+        output_path,
+        species,
+        sub_df,
+        trace.posterior,
+        ppc_summary,
+        plot_processes=plot_processes,
+        method=fit,
+    )
+
+
+def generate_batched_assets(
+    model_type,
+    df,
+    data,
+    output_path,
+    species_list,
+    cores=4,
+    samples=1000,
+    plot_processes=1,
+    backend="pymc",
+    fit="nuts",
+):
+    """Generate assets for all species from a single joint model"""
+    sub_df = df[df.primary_label.isin(species_list)].copy().fillna(0)
+
+    with span("model.build", model=model_type):
+        batched_model = make_model(model_type, data.subset(species_list), batched=True)
+    with batched_model:
+        with span("model.fit", method=fit, backend=backend):
+            trace = fit_posterior(samples, method=fit, cores=cores, backend=backend)
+        with span("model.ppc"):
+            ppc_summary = posterior_predictive_summary(trace)
+
+    # split the joint trace into the same shape as a single species fit, and
+    # render the plots for every species in one pool
+    assets = []
+    for species in species_list:
+        obs_idx = np.flatnonzero(sub_df.primary_label.values == species)
+        posterior = (
+            trace.posterior.sel(species_idx=species)
+            .isel(obs_idx=obs_idx)
+            .assign_coords(obs_idx=np.arange(len(obs_idx)))
+        )
+        species_df = add_predictions(
+            sub_df.iloc[obs_idx].copy(), ppc_summary.iloc[obs_idx]
+        )
+        assets.append((species, species_df, posterior))
+
+    with span("plot.render", n_species=len(assets)):
+        plot.render_plot_jobs(
+            [
+                job
+                for species, species_df, _ in assets
+                for job in plot_jobs(output_path, species, species_df)
+            ],
+            processes=plot_processes,
+            progress=True,
+        )
+    with span("model_assets.write_summary", n_species=len(assets)):
+        for species, species_df, posterior in assets:
+            write_summary(output_path, species, species_df, posterior, method=fit)
+
 
-    # save y and pred
-    sub_df["pred"] = ppc.posterior_predictive.y.values.reshape(
-        -1, sub_df.shape[0]
-    ).mean(axis=0)
+def write_assets(
+    output_path,
+    species,
+    sub_df,
+    posterior,
+    ppc_summary,
+    plot_processes=1,
+    method="nuts",
+):
+    """Write the trace summary, predictions and plots for a given species"""
+    sub_df = add_predictions(sub_df, ppc_summary)
+    with span("plot.render", species=species):
+        plot.render_plot_jobs(
+            plot_jobs(output_path, species, sub_df), processes=plot_processes
+        )
+    # the trace and ppc are written last, so a species with both files is
+    # complete and can be skipped when resuming
+    with span("model_assets.write_summary", species=species):
+        write_summary(output_path, species, sub_df, posterior, method=method)
+
+
+def add_predictions(sub_df, ppc_summary):
+    """Add the summary of the posterior predictive to the dataframe"""
+    sub_df["pred"] = ppc_summary["mean"].values
     sub_df["log_pred"] = np.log(sub_df.pred)
-    sub_df[
-        ["primary_label", "grid_id", "region", "grid_size", "y", "pred", "log_pred"]
-    ].to_json(f"{path}/ppc_{species}.json", orient="records")
+    sub_df["pred_sd"] = np.sqrt(ppc_summary["var"].values)
+    for col in ppc_summary.columns:
+        if col.startswith("q"):
+            sub_df[f"pred_{col}"] = ppc_summary[col].values
+    return sub_df
+
+
+def plot_jobs(output_path, species, sub_df):
+    """Plots of the observed and predicted counts for a given species"""
+    path = Path(output_path) / species
+    path.mkdir(parents=True, exist_ok=True)
 
     # try to use a consistent color scaling across plots of the same species
     vmin = 1e-1
     vmax = max(sub_df.y.max(), sub_df.pred.max())
 
-    sub_df["y_log"] = np.log(sub_df.y + vmin)
-    figsize = (5, 5)
-    plot_species(
-        sub_df,
-        species,
-        prop="y",
-        title=f"observed, {species}",
-        vmin=vmin,
-        vmax=vmax,
-        figsize=figsize,
+    values = lambda col: dict(zip(sub_df.grid_id, col))
+    common = dict(
+        region=sub_df.region.values[0],
+        grid_size=sub_df.grid_size.values[0],
+        figsize=(5, 5),
     )
-    plt.tight_layout()
-    plt.savefig(f"{path}/observed_{species}.png")
+    linear = dict(vmin=vmin, vmax=vmax, **common)
+    log = dict(vmin=np.log(vmin), vmax=np.log(vmax), **common)
+    return [
+        plot.PlotJob(
+            f"{path}/observed_{species}.png",
+            values=values(sub_df.y),
+            title=f"observed, {species}",
+            **linear,
+        ),
+        plot.PlotJob(
+            f"{path}/observed_{species}_log.png",
+            values=values(np.log(sub_df.y + vmin)),
+            title=f"observed, {species}, log scale",
+            **log,
+        ),
+        plot.PlotJob(
+            f"{path}/ppc_{species}_log.png",
+            values=values(sub_df.log_pred),
+            title=f"posterior predictive, {species}, log scale",
+            **log,
+        ),
+        plot.PlotJob(
+            f"{path}/ppc_{species}_linear.png",
+            values=values(sub_df.pred),
+            title=f"posterior predictive, {species}, linear scale",
+            **linear,
+        ),
+    ]
 
-    plot_species(
-        sub_df,
-        species,
-        prop="y_log",
-        title=f"observed, {species}, log scale",
-        vmin=np.log(vmin),
-        vmax=np.log(vmax),
-        figsize=figsize,
-    )
-    plt.tight_layout()
-    plt.savefig(f"{path}/observed_{species}_log.png")
 
-    plot_ppc_species(
-        sub_df,
-        ppc,
-        species,
-        prop="log_pred",
-        title=f"posterior predictive, {species}, log scale",
-        vmin=np.log(vmin),
-        vmax=np.log(vmax),
-        figsize=figsize,
-    )
-    plt.tight_layout()
-    plt.savefig(f"{path}/ppc_{species}_log.png")
+def write_summary(output_path, species, sub_df, posterior, method="nuts"):
+    """Write the trace summary and the posterior predictive for a species. The
+    summary records the method used to fit the posterior. Both are written as
+    json records, and as columnar float32 buffers for the app, followed by a
+    metadata sidecar for the manifest."""
+    path = Path(output_path) / species
+    path.mkdir(parents=True, exist_ok=True)
+    summary = az.summary(posterior, kind="stats", hdi_prob=0.95)
+    summary["method"] = method
+    pred_cols = [c for c in sub_df.columns if c.startswith("pred_")]
+    ppc_cols = ["y", "pred", "log_pred"] + pred_cols
 
-    plot_ppc_species(
-        sub_df,
-        ppc,
-        species,
-        prop="pred",
-        title=f"posterior predictive, {species}, linear scale",
-        vmin=vmin,
-        vmax=vmax,
-        figsize=figsize,
+    # the json files mark the species as complete, so the buffers go first
+    write_columnar(
+        path / f"trace_{species}.bin",
+        {c: summary[c] for c in summary.columns if c != "method"},
+        metadata=dict(index=summary.index.tolist(), method=method),
+    )
+    write_columnar(
+        path / f"ppc_{species}.bin",
+        {c: sub_df[c] for c in ppc_cols},
+        metadata=dict(
+            primary_label=species,
+            grid_id=sub_df.grid_id.tolist(),
+            region=sub_df.region.iloc[0],
+            grid_size=int(sub_df.grid_size.iloc[0]),
+        ),
     )
-    plt.tight_layout()
-    plt.savefig(f"{path}/ppc_{species}_linear.png")
+    summary.reset_index().to_json(
+        f"{path}/trace_{species}.json",
+        orient="records",
+    )
+    sub_df[["primary_label", "grid_id", "region", "grid_size"] + ppc_cols].to_json(
+        f"{path}/ppc_{species}.json", orient="records"
+    )
+    # a small sidecar with the metadata for generate_manifest, so it does not
+    # need to parse the ppc and trace files
+    metadata = dict(
+        primary_label=species,
+        region=sub_df.region.iloc[0],
+        grid_size=int(sub_df.grid_size.iloc[0]),
+        method=method,
+    )
+    tmp_path = path / f".meta_{species}.json.tmp"
+    tmp_path.write_text(json.dumps(metadata))
+    os.replace(tmp_path, path / f"meta_{species}.json")
+
+
+def is_complete(output_path, species):
+    """Check if the assets for a species have already been written"""
+    path = Path(output_path) / species
+    return (path / f"trace_{species}.json").exists() and (
+        path / f"ppc_{species}.json"
+    ).exists()
+
+
+# keyword arguments shared by every job in a worker process, which are sent
+# once per worker instead of with each job
+_shared_kwargs = {}
+
+
+def _init_worker(threads, shared_kwargs=None):
+    """Limit the number of BLAS threads, so concurrent jobs do not
+    oversubscribe the machine, and keep the arguments shared by the jobs"""
+    for var in ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[var] = str(threads)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        # the environment variables still apply to libraries that have not
+        # been loaded yet
+        pass
+    else:
+        threadpool_limits(threads)
+    _shared_kwargs.clear()
+    _shared_kwargs.update(shared_kwargs or {})
+
+
+def _timed_job(func, species):
+    start = time.time()
+    try:
+        with span("model_assets.species", species=species):
+            func(species=species, **_shared_kwargs)
+    except Exception:
+        traceback.print_exc()
+        return species, time.time() - start, False
+    return species, time.time() - start, True
+
+
+def run_jobs(func, species_list, jobs=1, threads=1, shared_kwargs=None):
+    """Run a job for each species across a pool of worker processes, and return
+    the wall time and status of each job. Large arguments that are the same for
+    every job, like the dataframe, are passed in shared_kwargs so they are only
+    sent to each worker once."""
+    with ProcessPoolExecutor(
+        jobs, initializer=_init_worker, initargs=(threads, shared_kwargs)
+    ) as executor:
+        futures = [executor.submit(_timed_job, func, s) for s in species_list]
+        return [
+            f.result() for f in tqdm.tqdm(as_completed(futures), total=len(futures))
+        ]
+
+
+def print_timings(timings):
+    """Print a table of wall time per job"""
+    print(f"{'species':<12} {'status':<8} {'seconds':>10}")
+    for species, elapsed, ok in sorted(timings, key=lambda t: -t[1]):
+        print(f"{species:<12} {'ok' if ok else 'failed':<8} {elapsed:>10.1f}")
+    print(f"{'total':<12} {'':<8} {sum(t[1] for t in timings):>10.1f}")
 
 
 def parse_args():
@@ -135,15 +400,81 @@ def parse_args():
         default=1000,
         help="Number of samples to use for pymc sampling",
     )
+    parser.add_argument(
+        "--sparse-car",
+        action="store_true",
+        help="Use a sparse CAR prior that scales with the number of edges",
+    )
+    parser.add_argument(
+        "--batched",
+        action="store_true",
+        help="Fit all species in a single model, which always uses a sparse CAR prior",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of species to fit at once, capped so jobs * cores <= cpu count",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Refit species that already have a trace and ppc in the output",
+    )
+    parser.add_argument(
+        "--plot-processes",
+        type=int,
+        default=1,
+        help="Number of processes to render plots with",
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="pymc",
+        choices=BACKENDS,
+        help="NUTS sampler to use, the jax backends run all chains in one process",
+    )
+    parser.add_argument(
+        "--fit",
+        type=str,
+        default="nuts",
+        choices=FIT_METHODS,
+        help="Fit with NUTS, or preview with a variational approximation",
+    )
+    parser.add_argument(
+        "--feature-set",
+        type=str,
+        default="all",
+        choices=list(FEATURE_SETS.keys()),
+        help="Named set of covariates for the covariate models",
+    )
+
+    add_profile_args(parser)
 
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
+    with profile_run(args.profile, trace_memory=args.profile_memory):
+        run(args)
 
-    prep_df, W = prepare_dataframe(args.input, args.train_metadata, n_species=None)
+
+def run(args):
+    with span("data.prepare_dataframe"):
+        prep_df, W = prepare_dataframe(
+            args.input,
+            args.train_metadata,
+            n_species=None,
+            dense=not (args.sparse_car or args.batched),
+        )
     prep_df = prep_df[prep_df.index.notnull()]
+    # the scaled covariates and indices are shared by every species, and the
+    # scaler is cached next to the input
+    with span("data.model_data"):
+        scaler = get_scaler(args.input, args.feature_set)
+        data = ModelData.from_dataframe(prep_df.fillna(0), W, scaler=scaler)
 
     # get the top n species
     top_species = (
@@ -155,17 +486,53 @@ def main():
     )
     print(top_species)
 
+    if args.batched:
+        generate_batched_assets(
+            args.model,
+            prep_df,
+            data,
+            args.output,
+            list(top_species),
+            cores=args.cores,
+            samples=args.samples,
+            plot_processes=args.plot_processes,
+            backend=args.backend,
+            fit=args.fit,
+        )
+        return
+
+    if not args.overwrite:
+        skipped = [s for s in top_species if is_complete(args.output, s)]
+        if skipped:
+            print(f"Skipping {len(skipped)} species with existing assets: {skipped}")
+        top_species = [s for s in top_species if s not in skipped]
+
+    # each job runs a chain per core, so budget the number of concurrent jobs
+    # and the BLAS threads for each job by the number of cpus
+    cpu_count = os.cpu_count() or 1
+    jobs = max(1, min(args.jobs, cpu_count // args.cores, len(top_species)))
+    threads = max(1, cpu_count // (jobs * args.cores))
+    print(f"Running {len(top_species)} species with {jobs} jobs")
+
     func = partial(
         generate_assets,
         args.model,
-        prep_df,
-        W,
-        args.output,
+        output_path=args.output,
         cores=args.cores,
         samples=args.samples,
+        sparse=args.sparse_car,
+        plot_processes=args.plot_processes,
+        backend=args.backend,
+        fit=args.fit,
+    )
+    timings = run_jobs(
+        func,
+        top_species,
+        jobs=jobs,
+        threads=threads,
+        shared_kwargs=dict(df=prep_df, data=data),
     )
-    for species in tqdm.tqdm(top_species):
-        func(species=species)
+    print_timings(timings)
 
 
 if __name__ == "__main__":
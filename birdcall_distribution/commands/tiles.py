@@ -0,0 +1,126 @@
+"""Serve map tiles of the model predictions, or pre-render them for the bucket.
+
+Tiles are addressed by the path of a directory of model assets relative to the
+root, e.g. `/intercept_car/americas/5/amecro/3/2/3.png?value=log_pred`. Png
+tiles are colored with the same colormap as the static plots, and geojson
+tiles contain the cells that overlap the tile with their values.
+"""
+from argparse import ArgumentParser
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from birdcall_distribution.commands.generate_manifest import build_manifest
+from birdcall_distribution.utils import lazy_import
+
+# matplotlib and the grids are only loaded when the first tile is rendered
+tiles = lazy_import("birdcall_distribution.tiles")
+
+CONTENT_TYPES = {"png": "image/png", "geojson": "application/geo+json"}
+
+
+def make_handler(root, cache_size=1024, max_renderers=32):
+    """Create a request handler for the model assets under a root directory.
+    Renderers are cached for the most recently used assets, and each of them
+    caches the tiles it has rendered."""
+    root = Path(root).resolve()
+
+    @lru_cache(maxsize=max_renderers)
+    def get_renderer(path, value):
+        return tiles.TileRenderer.from_assets(root / path, value, cache_size=cache_size)
+
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+            if len(parts) < 4:
+                self.send_error(404)
+                return
+            *parts, z, x, name = parts
+            y, _, fmt = name.partition(".")
+            path = root.joinpath(*parts).resolve()
+            if (
+                fmt not in CONTENT_TYPES
+                or not (z.isdigit() and x.isdigit() and y.isdigit())
+                or root not in path.parents
+                or not list(path.glob("ppc_*"))
+            ):
+                self.send_error(404)
+                return
+            value = parse_qs(url.query).get("value", ["log_pred"])[0]
+            try:
+                renderer = get_renderer(path.relative_to(root).as_posix(), value)
+            except KeyError:
+                self.send_error(400, f"Unknown value: {value}")
+                return
+            if fmt == "png":
+                data = renderer.png(int(z), int(x), int(y))
+            else:
+                data = renderer.geojson(int(z), int(x), int(y)).encode()
+            if data is None:
+                self.send_response(204)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPES[fmt])
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.send_header("Cache-Control", "public, max-age=3600")
+            self.end_headers()
+            self.wfile.write(data)
+
+    return TileHandler
+
+
+def serve(args):
+    server = ThreadingHTTPServer(
+        (args.host, args.port), make_handler(args.root, cache_size=args.cache_size)
+    )
+    print(f"Serving tiles for {args.root} on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+def pyramid(args):
+    root = Path(args.root)
+    paths = args.paths or [item["path"] for item in build_manifest(root)[0]]
+    for path in paths:
+        renderer = tiles.TileRenderer.from_assets(root / path, args.value)
+        n_tiles = renderer.write_pyramid(
+            root / path / "tiles", min_zoom=args.min_zoom, max_zoom=args.max_zoom
+        )
+        print(f"Wrote {n_tiles} tiles for {path}")
+
+
+def main():
+    """Serve or pre-render map tiles of the per-cell predictions."""
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="render tiles on demand")
+    serve_parser.add_argument("root", type=str)
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8001)
+    serve_parser.add_argument(
+        "--cache-size", type=int, default=1024, help="number of tiles to cache"
+    )
+    serve_parser.set_defaults(func=serve)
+
+    pyramid_parser = subparsers.add_parser(
+        "pyramid", help="write png tiles next to the model assets"
+    )
+    pyramid_parser.add_argument("root", type=str)
+    pyramid_parser.add_argument(
+        "paths", type=str, nargs="*", help="asset directories, defaults to all"
+    )
+    pyramid_parser.add_argument("--value", type=str, default="log_pred")
+    pyramid_parser.add_argument("--min-zoom", type=int, default=0)
+    pyramid_parser.add_argument("--max-zoom", type=int, default=6)
+    pyramid_parser.set_defaults(func=pyramid)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
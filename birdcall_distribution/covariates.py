@@ -0,0 +1,489 @@
+"""Extract covariates for the cells of a grid from remote sensing datasets.
+
+Statistics are computed for many cells at once by a backend, and cached on
+disk per cell, dataset, date range, and scale so that reruns only need to
+fetch the cells that are missing. The Earth Engine backend issues a single
+reduceRegions request per chunk of cells, while the local backend reads rasters
+from numpy or GeoTIFF files so the pipeline can run without network access.
+"""
+import json
+import os
+import random
+import time
+from multiprocessing import BoundedSemaphore, Pool
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from shapely.geometry import mapping
+from tqdm.auto import tqdm
+
+from birdcall_distribution.profiling import span
+
+COVARIATE_CACHE_DIR = Path(
+    os.environ.get(
+        "BIRDCALL_COVARIATE_CACHE",
+        Path.home() / ".cache" / "birdcall_distribution" / "covariates",
+    )
+)
+DATASETS = ["population", "elevation", "surface_temperature", "land_cover"]
+PERCENTILES = [5, 50, 95]
+LAND_COVER_CLASSES = list(range(1, 18))
+SURFACE_TEMPERATURE_BANDS = ["LST_Day_1km", "LST_Night_1km"]
+COLUMNS = [
+    "population_density",
+    *[f"elevation_p{p}" for p in PERCENTILES],
+    *[f"{band}_p{p}" for band in SURFACE_TEMPERATURE_BANDS for p in PERCENTILES],
+    *[f"land_cover_{k:02d}" for k in LAND_COVER_CLASSES],
+]
+
+
+def t_modis_to_celsius(t_modis):
+    """Converts MODIS LST units to degrees Celsius."""
+    if t_modis is None:
+        return None
+    t_celsius = 0.02 * t_modis - 273.15
+    return t_celsius
+
+
+def _postprocess(dataset, props):
+    """Convert the raw output of a reducer into the columns of the dataset.
+
+    Reducers over a single band may drop the band name from the output, so we
+    accept both forms.
+    """
+    if dataset == "population":
+        value = props.get("population_density", props.get("sum"))
+        return {"population_density": value}
+    if dataset == "elevation":
+        return {
+            f"elevation_p{p}": props.get(f"elevation_p{p}", props.get(f"p{p}"))
+            for p in PERCENTILES
+        }
+    if dataset == "surface_temperature":
+        return {
+            f"{band}_p{p}": t_modis_to_celsius(props.get(f"{band}_p{p}"))
+            for band in SURFACE_TEMPERATURE_BANDS
+            for p in PERCENTILES
+        }
+    if dataset == "land_cover":
+        # count the total number of pixels, do not smooth to account for differences
+        hist = props.get("histogram", props.get("LC_Type1")) or {}
+        return {
+            f"land_cover_{k:02d}": int(hist.get(str(k), 0)) for k in LAND_COVER_CLASSES
+        }
+    raise ValueError(f"Unknown dataset: {dataset}")
+
+
+class EarthEngineBackend:
+    """Compute statistics for many cells at once with reduceRegions."""
+
+    def __init__(self):
+        self._initialized = False
+
+    def initialize(self):
+        """Initialize Earth Engine once per process."""
+        if not self._initialized:
+            import ee
+
+            ee.Initialize()
+            self._initialized = True
+
+    def _image_and_reducer(self, dataset, start_ds, end_ds):
+        import ee
+
+        if dataset == "population":
+            image = (
+                ee.ImageCollection("CIESIN/GPWv411/GPW_Population_Density")
+                .select("population_density")
+                .limit(1, "system:time_start", False)
+                .first()
+            )
+            return image, ee.Reducer.sum()
+        if dataset == "elevation":
+            # Import the USGS ground elevation image.
+            image = ee.Image("USGS/SRTMGL1_003").select("elevation")
+            return image, ee.Reducer.percentile(PERCENTILES)
+        if dataset == "surface_temperature":
+            # Import the MODIS land surface temperature collection.
+            image = (
+                ee.ImageCollection("MODIS/006/MOD11A1")
+                .select(*SURFACE_TEMPERATURE_BANDS)
+                .filterDate(start_ds, end_ds)
+                .mean()
+            )
+            return image, ee.Reducer.percentile(PERCENTILES)
+        if dataset == "land_cover":
+            # Import the MODIS land cover collection, and count pixels by their
+            # center like sampling the region would.
+            # https://developers.google.com/earth-engine/datasets/catalog/MODIS_006_MCD12Q1#bands
+            image = ee.ImageCollection("MODIS/006/MCD12Q1").first().select("LC_Type1")
+            return image, ee.Reducer.frequencyHistogram().unweighted()
+        raise ValueError(f"Unknown dataset: {dataset}")
+
+    def reduce(self, dataset, cells, start_ds, end_ds, scale):
+        """Get the raw statistics of a dataset for a dictionary of cells."""
+        import ee
+
+        self.initialize()
+        collection = ee.FeatureCollection(
+            [
+                ee.Feature(
+                    ee.Geometry.Polygon(mapping(polygon)["coordinates"]),
+                    {"name": key},
+                )
+                for key, polygon in cells.items()
+            ]
+        )
+        image, reducer = self._image_and_reducer(dataset, start_ds, end_ds)
+        result = image.reduceRegions(
+            collection=collection, reducer=reducer, scale=scale
+        ).getInfo()
+        return {
+            feature["properties"]["name"]: feature["properties"]
+            for feature in result["features"]
+        }
+
+
+class LocalRasterBackend:
+    """Compute statistics from local rasters, as a stand-in for Earth Engine in
+    tests and benchmarks.
+
+    The directory contains a `{dataset}.npz` file for each dataset, with a
+    `data` array of shape (bands, rows, cols), a list of `bands` and the
+    `extent` of the raster as (xmin, xmax, ymin, ymax). The first row is the
+    northern edge. A `{dataset}.tif` GeoTIFF can be used instead if rasterio is
+    installed. Surface temperature is expected to already be averaged over
+    time, in MODIS units. Pixels are assigned to a cell by their center.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._rasters = {}
+
+    def initialize(self):
+        pass
+
+    def _load(self, dataset):
+        if dataset in self._rasters:
+            return self._rasters[dataset]
+        npz_path = self.path / f"{dataset}.npz"
+        if npz_path.exists():
+            with np.load(npz_path) as f:
+                data = f["data"]
+                if data.ndim == 2:
+                    data = data[None]
+                raster = (data, list(f["bands"]), tuple(f["extent"].tolist()))
+        else:
+            import rasterio
+
+            with rasterio.open(self.path / f"{dataset}.tif") as f:
+                bounds = f.bounds
+                raster = (
+                    f.read(),
+                    list(f.descriptions),
+                    (bounds.left, bounds.right, bounds.bottom, bounds.top),
+                )
+        self._rasters[dataset] = raster
+        return raster
+
+    def reduce(self, dataset, cells, start_ds, end_ds, scale):
+        """Get the raw statistics of a dataset for a dictionary of cells. The
+        date range and scale are fixed by the raster."""
+        data, bands, (xmin, xmax, ymin, ymax) = self._load(dataset)
+        _, n_rows, n_cols = data.shape
+        lon = xmin + (np.arange(n_cols) + 0.5) * (xmax - xmin) / n_cols
+        lat = ymax - (np.arange(n_rows) + 0.5) * (ymax - ymin) / n_rows
+
+        results = {}
+        for key, polygon in cells.items():
+            minx, miny, maxx, maxy = polygon.bounds
+            cols = (lon >= minx) & (lon < maxx)
+            rows = (lat >= miny) & (lat < maxy)
+            pixels = data[:, rows][:, :, cols].reshape(len(bands), -1)
+            props = {}
+            for band, values in zip(bands, pixels):
+                values = values[np.isfinite(values)]
+                if dataset == "population":
+                    props[band] = float(values.sum())
+                elif dataset == "land_cover":
+                    classes, counts = np.unique(values.astype(int), return_counts=True)
+                    props["histogram"] = {
+                        str(k): int(n) for k, n in zip(classes, counts)
+                    }
+                else:
+                    for p in PERCENTILES:
+                        props[f"{band}_p{p}"] = (
+                            float(np.percentile(values, p)) if len(values) else None
+                        )
+            results[key] = props
+        return results
+
+
+def make_synthetic_rasters(path, extent, resolution=0.1, seed=0):
+    """Write smooth random rasters for each dataset for the local backend."""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    xmin, xmax, ymin, ymax = extent
+    n_cols = int(round((xmax - xmin) / resolution))
+    n_rows = int(round((ymax - ymin) / resolution))
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0 : 1 : n_rows * 1j, 0 : 1 : n_cols * 1j]
+
+    def field():
+        a, b, c = rng.uniform(1, 6, size=3)
+        return np.sin(a * x + c) * np.cos(b * y) + 0.1 * rng.normal(size=x.shape)
+
+    rasters = {
+        "population": (
+            [np.exp(3 * field()).astype(np.float32)],
+            ["population_density"],
+        ),
+        "elevation": ([(1000 + 1000 * field()).astype(np.float32)], ["elevation"]),
+        "surface_temperature": (
+            [
+                ((300 + 10 * field()) / 0.02).astype(np.float32),
+                ((280 + 10 * field()) / 0.02).astype(np.float32),
+            ],
+            SURFACE_TEMPERATURE_BANDS,
+        ),
+        "land_cover": (
+            [np.digitize(field(), np.linspace(-1, 1, 16)).astype(np.float32) + 1],
+            ["LC_Type1"],
+        ),
+    }
+    for dataset, (data, bands) in rasters.items():
+        np.savez(
+            path / f"{dataset}.npz",
+            data=np.stack(data),
+            bands=np.array(bands),
+            extent=np.array(extent, dtype=float),
+        )
+    return path
+
+
+class CovariateCache:
+    """Cache of covariates per cell on disk. Each dataset, date range, and
+    scale is stored as a json lines file, keyed by the bounds of the cell so
+    that cells from grids of different sizes do not collide."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._entries = {}
+
+    @staticmethod
+    def cell_id(polygon):
+        return ",".join(repr(float(b)) for b in polygon.bounds)
+
+    def _file(self, dataset, start_ds, end_ds, scale):
+        return self.path / f"{dataset}_{start_ds}_{end_ds}_{scale}.jsonl"
+
+    def _load(self, *args):
+        path = self._file(*args)
+        if path not in self._entries:
+            entries = {}
+            if path.exists():
+                for line in path.read_text().splitlines():
+                    # ignore a partially written line from an interrupted run
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    entries[row["cell"]] = row["values"]
+            self._entries[path] = entries
+        return self._entries[path]
+
+    def get(self, dataset, polygon, start_ds, end_ds, scale):
+        entries = self._load(dataset, start_ds, end_ds, scale)
+        return entries.get(self.cell_id(polygon))
+
+    def put(self, dataset, values_by_polygon, start_ds, end_ds, scale):
+        entries = self._load(dataset, start_ds, end_ds, scale)
+        path = self._file(dataset, start_ds, end_ds, scale)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            for polygon, values in values_by_polygon:
+                cell = self.cell_id(polygon)
+                entries[cell] = values
+                f.write(json.dumps(dict(cell=cell, values=values)) + "\n")
+
+
+_worker_backend = None
+_worker_limits = None
+_worker_retry = None
+
+
+def _init_worker(backend, limits=None, retry=(0, 1.0)):
+    global _worker_backend, _worker_limits, _worker_retry
+    _worker_backend = backend
+    _worker_limits = limits or {}
+    _worker_retry = retry
+    _worker_backend.initialize()
+
+
+def _reduce_with_retry(dataset, cells, start_ds, end_ds, scale):
+    """Reduce cells with the worker backend, holding the concurrency limit for
+    the dataset and retrying failed requests with exponential backoff."""
+    max_retries, backoff = _worker_retry
+    limit = _worker_limits.get(dataset)
+    for attempt in range(max_retries + 1):
+        try:
+            if limit is None:
+                return _worker_backend.reduce(dataset, cells, start_ds, end_ds, scale)
+            with limit:
+                return _worker_backend.reduce(dataset, cells, start_ds, end_ds, scale)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2**attempt * (1 + random.random())
+            print(f"Request for {dataset} failed ({e!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _reduce_chunk(args):
+    missing, start_ds, end_ds, scale = args
+    results = {}
+    for dataset, cells in missing.items():
+        with span("covariates.reduce", dataset=dataset, n_cells=len(cells)):
+            raw = _reduce_with_retry(dataset, cells, start_ds, end_ds, scale)
+        results[dataset] = {
+            key: _postprocess(dataset, raw.get(key, {})) for key in cells
+        }
+    return results
+
+
+def iter_covariates(
+    grid,
+    backend,
+    cache=None,
+    start_ds="2019-01-01",
+    end_ds="2022-01-01",
+    scale=1000,
+    datasets=DATASETS,
+    chunk_size=100,
+    parallelism=1,
+    max_concurrent=None,
+    max_retries=0,
+    backoff=1.0,
+):
+    """Get statistics for population, elevation, temperature, and land cover
+    for every cell in a grid, yielding the rows of each chunk of cells as it
+    completes.
+
+    Only cells that are missing from the cache are sent to the backend, in
+    chunks of cells per request that are spread over a pool of processes. At
+    most `max_concurrent` requests for each dataset run at the same time, and
+    failed requests are retried up to `max_retries` times.
+    """
+    params = (start_ds, end_ds, scale)
+    keys = list(grid.keys())
+    chunks = [keys[i : i + chunk_size] for i in range(0, len(keys), chunk_size)]
+
+    def cached_values(chunk):
+        values = {dataset: {} for dataset in datasets}
+        missing = {dataset: {} for dataset in datasets}
+        for dataset in datasets:
+            for key in chunk:
+                cached = cache.get(dataset, grid[key], *params) if cache else None
+                if cached is None:
+                    missing[dataset][key] = grid[key]
+                else:
+                    values[dataset][key] = cached
+        return values, {k: v for k, v in missing.items() if v}
+
+    def rows(chunk, values):
+        return [
+            dict(
+                name=key, **{c: v for d in datasets for c, v in values[d][key].items()}
+            )
+            for key in chunk
+        ]
+
+    tasks = []
+    for chunk in chunks:
+        values, missing = cached_values(chunk)
+        if missing:
+            tasks.append((chunk, values, missing))
+        else:
+            yield rows(chunk, values)
+    if not tasks:
+        return
+
+    limits = None
+    if max_concurrent:
+        limits = {dataset: BoundedSemaphore(max_concurrent) for dataset in datasets}
+    with Pool(
+        min(parallelism, len(tasks)),
+        initializer=_init_worker,
+        initargs=(backend, limits, (max_retries, backoff)),
+    ) as p:
+        results = p.imap(_reduce_chunk, [(missing, *params) for _, _, missing in tasks])
+        for (chunk, values, _), result in tqdm(zip(tasks, results), total=len(tasks)):
+            for dataset, fetched in result.items():
+                values[dataset].update(fetched)
+                if cache:
+                    cache.put(
+                        dataset,
+                        [(grid[key], row) for key, row in fetched.items()],
+                        *params,
+                    )
+            yield rows(chunk, values)
+
+
+def extract_covariates(grid, backend, cache=None, **kwargs):
+    """Get statistics for every cell in a grid. Returns a list of rows in the
+    order of the grid. See `iter_covariates` for the arguments."""
+    rows = {}
+    for chunk in iter_covariates(grid, backend, cache=cache, **kwargs):
+        rows.update({row["name"]: row for row in chunk})
+    return [rows[key] for key in grid]
+
+
+def _part_paths(parts_dir):
+    return sorted(Path(parts_dir).glob("part-*.parquet"))
+
+
+def run_covariate_job(
+    grid, backend, output, cache=None, region=None, grid_size=None, **kwargs
+):
+    """Extract covariates for a grid into a parquet file, checkpointing each
+    chunk of cells into an append-only part file next to the output.
+
+    A restarted job skips the cells that have already been written. Once every
+    cell is done, the parts are compacted into the output in the order of the
+    grid and removed.
+    """
+    output = Path(output)
+    parts_dir = output.parent / f"{output.name}.parts"
+    parts_dir.mkdir(parents=True, exist_ok=True)
+
+    parts = _part_paths(parts_dir)
+    done = set()
+    for path in parts:
+        done.update(pd.read_parquet(path, columns=["name"])["name"])
+    if done:
+        print(f"Resuming with {len(done)} of {len(grid)} cells already written")
+
+    remaining = {key: polygon for key, polygon in grid.items() if key not in done}
+    n_parts = len(parts)
+    for rows in iter_covariates(remaining, backend, cache=cache, **kwargs):
+        path = parts_dir / f"part-{n_parts:05d}.parquet"
+        # write to a temporary file first, so a part is either complete or absent
+        tmp = path.with_suffix(".tmp")
+        pd.DataFrame(rows, columns=["name", *COLUMNS]).to_parquet(tmp)
+        os.replace(tmp, path)
+        n_parts += 1
+
+    with span("covariates.compact", n_parts=n_parts):
+        df = pd.concat([pd.read_parquet(path) for path in _part_paths(parts_dir)])
+        df = df.drop_duplicates("name").set_index("name").loc[list(grid)]
+        df = df.reset_index()
+    df.insert(1, "grid_size", grid_size)
+    df.insert(1, "region", region)
+    tmp = output.parent / f".{output.name}.tmp"
+    df.to_parquet(tmp)
+    os.replace(tmp, output)
+    for path in parts_dir.iterdir():
+        path.unlink()
+    parts_dir.rmdir()
+    return df
@@ -1,18 +1,29 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+
 import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
+from scipy import sparse
 
+from birdcall_distribution.covariates import COLUMNS
 from birdcall_distribution.geo import (
     add_lonlat_columns,
-    convert_to_adjacency_matrix,
-    generate_grid_adjacency_list,
     get_adjacency_mapping,
     get_grid_meta,
 )
+from birdcall_distribution.profiling import span
+
 
+def prepare_counts(ee_path, train_path, n_species=3, dense=True):
+    """Count the observed calls for each species in each cell of the grid.
 
-def prepare_dataframe(ee_path, train_path, n_species=3):
-    """Prepare dataframe and adjacency matrix for fitting"""
+    Returns a (species x cell) array of counts, the species labels, the earth
+    engine covariates with one row per cell, and the adjacency matrix. Cells are
+    in the order of the adjacency matrix, and species are sorted by name.
+    """
 
     # dataset with our data from earth engine
     ee_df = pd.read_parquet(ee_path)
@@ -21,42 +32,73 @@ def prepare_dataframe(ee_path, train_path, n_species=3):
 
     grid_meta = get_grid_meta(region, grid_size)
 
-    adjacency_list = generate_grid_adjacency_list(grid_meta.grid)
-    mapping = get_adjacency_mapping(adjacency_list)
-    W = convert_to_adjacency_matrix(adjacency_list)
+    mapping = get_adjacency_mapping(grid_meta.grid)
+    W = grid_meta.adjacency.toarray() if dense else grid_meta.adjacency
 
     # pull out species and longitude/latitude data from the kaggle dataset
-    df = pd.read_csv(train_path)
-    df = df[["primary_label", "latitude", "longitude"]].dropna()
-    df = add_lonlat_columns(df, grid_meta.grid)
-    df = df[df.grid.notnull()]
-    df["adjacency_idx"] = df.grid_id.apply(lambda x: mapping.get(x, None))
+    with span("data.read_recordings"):
+        df = pd.read_csv(train_path)
+        df = df[["primary_label", "latitude", "longitude"]].dropna()
+    with span("data.add_lonlat_columns", n_recordings=len(df)):
+        df = add_lonlat_columns(df, grid_meta.grid)
+        df = df[df.grid.notnull()]
 
     # now modify the species list so we only keep the top n
+    labels = df.primary_label
     if n_species:
-        top_n = (
-            df[["primary_label"]]
-            .groupby("primary_label")
-            .value_counts()
-            .sort_values(ascending=False)[:n_species]
-        )
-        df["primary_label"] = df.primary_label.apply(
-            lambda x: x if x in top_n.index else "other"
+        top_n = labels.value_counts().index[:n_species]
+        labels = labels.where(labels.isin(top_n), "other")
+
+    species = pd.Index(np.sort(labels.unique()), name="primary_label")
+    species_codes = species.get_indexer(labels)
+    cell_codes = df.grid_id.map(mapping).values.astype(int)
+    counts = np.bincount(
+        species_codes * len(mapping) + cell_codes,
+        minlength=len(species) * len(mapping),
+    ).reshape(len(species), len(mapping))
+
+    ee_df = ee_df.rename(columns={"name": "grid_id"}).set_index("grid_id")
+    ee_df = ee_df.reindex(list(mapping.keys())).reset_index()
+    ee_df.index = pd.RangeIndex(len(mapping), name="adjacency_idx")
+
+    return counts, species, ee_df, W
+
+
+def prepare_dataframe(ee_path, train_path, n_species=3, dense=True):
+    """Prepare dataframe and adjacency matrix for fitting. The adjacency matrix
+    is a scipy sparse matrix unless dense is set.
+
+    The dataframe has a row for each species in each cell, indexed by the
+    adjacency index of the cell. Counts are missing for cells where a species
+    was not observed.
+    """
+    with span("data.prepare_counts"):
+        counts, species, ee_df, W = prepare_counts(
+            ee_path, train_path, n_species, dense
         )
+    n_species, n_cells = counts.shape
 
-    # count number of observed calls per adjacency index, and join against the ee variables
-    group_cols = ["primary_label", "grid_id"]
-    counts_df = df[group_cols].groupby(group_cols).value_counts().reset_index()
-    counts_df.columns = group_cols + ["y"]
+    # the covariates are only repeated for each species here, at the very end
+    cell_idx = np.repeat(np.arange(n_cells), n_species)
+    species_idx = np.tile(np.arange(n_species), n_cells)
+    y = counts[species_idx, cell_idx].astype(float)
+    y[y == 0] = np.nan
 
-    ee_with_species = ee_df.rename(columns={"name": "grid_id"}).merge(
-        pd.DataFrame({"primary_label": df.primary_label.unique()}), how="cross"
+    covariates = ee_df.drop(columns="grid_id").take(cell_idx)
+    prep_df = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "primary_label": species.values[species_idx],
+                    "grid_id": ee_df.grid_id.values[cell_idx],
+                    "y": y,
+                },
+                index=covariates.index,
+            ),
+            covariates,
+        ],
+        axis="columns",
     )
-    prep_df = counts_df.merge(
-        ee_with_species, on=["grid_id", "primary_label"], how="outer"
-    )
-    prep_df["adjacency_idx"] = prep_df.grid_id.apply(lambda x: mapping.get(x, None))
-    prep_df = prep_df.set_index("adjacency_idx").sort_index()
 
     landcover_cols = [c for c in prep_df.columns if c.startswith("land_cover")]
     prep_df["sum_land_cover"] = prep_df[landcover_cols].sum(axis="columns")
@@ -64,9 +106,50 @@ def prepare_dataframe(ee_path, train_path, n_species=3):
     return prep_df, W
 
 
+def make_synthetic_recordings(
+    region, grid_size, n_recordings=10000, n_species=50, seed=0
+):
+    """Generate recording metadata in the same format as the kaggle training
+    metadata, for benchmarks and runs without the kaggle dataset.
+
+    The frequency of each species follows a power law, and each species is
+    recorded more often close to a random center in the grid.
+    """
+    rng = np.random.default_rng(seed)
+    grid_meta = get_grid_meta(region, grid_size)
+    bounds = np.array([p.bounds for p in grid_meta.grid.values()])
+    centers = (bounds[:, :2] + bounds[:, 2:]) / 2
+    scale = np.ptp(centers, axis=0).max() / 4 or 1
+
+    weights = 1 / np.arange(1, n_species + 1)
+    species_idx = rng.choice(n_species, size=n_recordings, p=weights / weights.sum())
+    cell_idx = np.empty(n_recordings, dtype=int)
+    for i, center in enumerate(rng.choice(len(centers), size=n_species)):
+        distance = np.linalg.norm(centers - centers[center], axis=1)
+        p = np.exp(-((distance / scale) ** 2))
+        mask = species_idx == i
+        cell_idx[mask] = rng.choice(len(centers), size=mask.sum(), p=p / p.sum())
+
+    # points are uniform within each cell, away from the edges so they are
+    # always assigned to the cell
+    offsets = rng.uniform(0.01, 0.99, size=(n_recordings, 2))
+    lonlat = bounds[cell_idx, :2] + offsets * (
+        bounds[cell_idx, 2:] - bounds[cell_idx, :2]
+    )
+    return pd.DataFrame(
+        {
+            "primary_label": [f"synth{i:03d}" for i in species_idx],
+            "latitude": lonlat[:, 1].round(4),
+            "longitude": lonlat[:, 0].round(4),
+        }
+    )
+
+
 def prepare_scaled_data(
     df, data_cols, log_cols=[], intercept=True, return_scaler=False
 ):
+    from sklearn.preprocessing import StandardScaler
+
     scaler = StandardScaler()
     temp_df = df[data_cols].copy()
 
@@ -84,3 +167,211 @@ def prepare_scaled_data(
         return scaled_data_df, scaler
     else:
         return scaled_data_df
+
+
+@dataclass
+class FeatureSet:
+    """Covariates for a model, and the counts that are log transformed before
+    they are standardized."""
+
+    columns: list
+    log_columns: list = field(default_factory=list)
+    intercept: bool = False
+
+
+_LANDCOVER_SELECTED = [f"land_cover_{i:02d}" for i in [7, 8, 9, 10, 16]]
+FEATURE_SETS = {
+    # every covariate from earth engine
+    "all": FeatureSet(
+        columns=COLUMNS,
+        log_columns=[c for c in COLUMNS if "population" in c or "land_cover" in c],
+    ),
+    # a smaller set of covariates that were used in earlier models
+    "selected": FeatureSet(
+        columns=[
+            "population_density",
+            "elevation_p50",
+            "LST_Day_1km_p95",
+            "LST_Night_1km_p5",
+            *_LANDCOVER_SELECTED,
+        ],
+        log_columns=["population_density", *_LANDCOVER_SELECTED],
+    ),
+}
+
+
+@dataclass
+class Scaler:
+    """Standardize the columns of a feature set, with the means and scales
+    fitted on the cells of the earth engine dataset. New observations are
+    transformed with the same parameters."""
+
+    feature_set: FeatureSet
+    mean: np.ndarray
+    scale: np.ndarray
+
+    @property
+    def features(self):
+        intercept = ["intercept"] if self.feature_set.intercept else []
+        return intercept + list(self.feature_set.columns)
+
+    @staticmethod
+    def _log(df, feature_set):
+        X = df[feature_set.columns].to_numpy(dtype=float, copy=True)
+        for i, col in enumerate(feature_set.columns):
+            if col in feature_set.log_columns:
+                X[:, i] = np.log(X[:, i] + 1)
+        return X
+
+    @classmethod
+    def fit(cls, df, feature_set):
+        X = cls._log(df, feature_set)
+        mean = np.nanmean(X, axis=0)
+        scale = np.nanstd(X, axis=0)
+        # constant columns are only centered, like sklearn's StandardScaler
+        scale[scale == 0] = 1
+        return cls(feature_set, mean, scale)
+
+    def transform(self, df):
+        """Get the scaled (observation x feature) matrix for a dataframe."""
+        X = (self._log(df, self.feature_set) - self.mean) / self.scale
+        if self.feature_set.intercept:
+            X = np.hstack([np.ones((X.shape[0], 1)), X])
+        return X.astype(np.float32)
+
+    def to_dict(self):
+        return dict(
+            feature_set=asdict(self.feature_set),
+            mean=self.mean.tolist(),
+            scale=self.scale.tolist(),
+        )
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            FeatureSet(**d["feature_set"]), np.array(d["mean"]), np.array(d["scale"])
+        )
+
+
+def scaler_path(ee_path):
+    """Fitted scalers are saved next to the earth engine dataset."""
+    ee_path = Path(ee_path)
+    return ee_path.with_name(f"{ee_path.stem}.scalers.json")
+
+
+def get_scaler(ee_path, feature_set="all", cache=True):
+    """Get the scaler for a named feature set of an earth engine dataset. The
+    fitted parameters are cached in a file next to the dataset, and are refit
+    when the dataset or the feature set changes."""
+    definition = FEATURE_SETS[feature_set]
+    source = hashlib.sha256(Path(ee_path).read_bytes()).hexdigest()
+    path = scaler_path(ee_path)
+
+    cached = json.loads(path.read_text()) if cache and path.exists() else {}
+    if cached.get("source") != source:
+        cached = dict(source=source, scalers={})
+    entry = cached["scalers"].get(feature_set)
+    if entry is not None and entry["feature_set"] == asdict(definition):
+        return Scaler.from_dict(entry)
+
+    with span("data.fit_scaler", feature_set=feature_set):
+        scaler = Scaler.fit(pd.read_parquet(ee_path).fillna(0), definition)
+    if cache:
+        cached["scalers"][feature_set] = scaler.to_dict()
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(cached, indent=2))
+        os.replace(tmp_path, path)
+    return scaler
+
+
+@dataclass
+class ModelData:
+    """Arrays for fitting the models, with an observation for each species in
+    each cell. The scaled covariates are stored once per cell instead of once
+    per observation, and cells are in the order of the adjacency matrix."""
+
+    species: np.ndarray
+    cells: np.ndarray
+    features: np.ndarray
+    species_idx: np.ndarray
+    cell_idx: np.ndarray
+    y: np.ndarray
+    covariates: np.ndarray
+    adjacency: sparse.csr_matrix = None
+
+    @classmethod
+    def from_dataframe(cls, prep_df, W=None, scaler=None):
+        """Build the arrays from the output of prepare_dataframe. The
+        covariates are scaled with all of the earth engine covariates, fit on
+        the cells in the dataframe, unless a scaler is given."""
+        species_cat = prep_df.primary_label.astype("category")
+        cell_idx = prep_df.index.values.astype(np.int32)
+        n_cells = W.shape[0] if W is not None else cell_idx.max() + 1
+
+        # every cell has the same covariates for each species
+        cell_df = prep_df[~prep_df.index.duplicated()]
+        if scaler is None:
+            scaler = Scaler.fit(cell_df, FEATURE_SETS["all"])
+        covariates = np.zeros((n_cells, len(scaler.features)), dtype=np.float32)
+        covariates[cell_df.index.values.astype(int)] = scaler.transform(cell_df)
+        cells = np.full(n_cells, "", dtype=object)
+        cells[cell_df.index.values.astype(int)] = cell_df.grid_id.values
+
+        return cls(
+            species=np.array(species_cat.cat.categories, dtype=str),
+            cells=cells.astype(str),
+            features=np.array(scaler.features, dtype=str),
+            species_idx=species_cat.cat.codes.values.astype(np.int32),
+            cell_idx=cell_idx,
+            y=prep_df.y.values.astype(float),
+            covariates=covariates,
+            adjacency=None if W is None else sparse.csr_matrix(W),
+        )
+
+    def subset(self, species):
+        """Keep the observations of a list of species, in their original order."""
+        keep = np.isin(self.species, species)
+        mask = keep[self.species_idx]
+        codes = np.cumsum(keep) - 1
+        return ModelData(
+            species=self.species[keep],
+            cells=self.cells,
+            features=self.features,
+            species_idx=codes[self.species_idx[mask]].astype(np.int32),
+            cell_idx=self.cell_idx[mask],
+            y=self.y[mask],
+            covariates=self.covariates,
+            adjacency=self.adjacency,
+        )
+
+    def save(self, path):
+        """Save the arrays to a single npz file."""
+        arrays = {
+            f.name: getattr(self, f.name) for f in fields(self) if f.name != "adjacency"
+        }
+        if self.adjacency is not None:
+            arrays.update(
+                adjacency_data=self.adjacency.data,
+                adjacency_indices=self.adjacency.indices,
+                adjacency_indptr=self.adjacency.indptr,
+                adjacency_shape=np.array(self.adjacency.shape),
+            )
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            adjacency = None
+            if "adjacency_data" in f:
+                adjacency = sparse.csr_matrix(
+                    (
+                        f["adjacency_data"],
+                        f["adjacency_indices"],
+                        f["adjacency_indptr"],
+                    ),
+                    shape=tuple(f["adjacency_shape"]),
+                )
+            return cls(
+                **{f_.name: f[f_.name] for f_ in fields(cls) if f_.name != "adjacency"},
+                adjacency=adjacency,
+            )
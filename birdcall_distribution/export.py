@@ -0,0 +1,94 @@
+"""Columnar exports of the model outputs for the web app.
+
+Each file starts with a 4 byte magic string and the length of a JSON header as
+a little-endian uint32. The header lists the columns, their byte offsets from
+the end of the header and the number of rows, along with any string metadata
+such as the grid ids. It is followed by every column as a little-endian float32
+array, so the app can read them directly into typed arrays. Precompressed gzip
+and brotli variants are written next to each file.
+"""
+import gzip
+import json
+import struct
+from pathlib import Path
+
+from .utils import lazy_import
+
+# the manifest only needs the encodings, so numpy is imported on first use
+np = lazy_import("numpy")
+
+MAGIC = b"BCD1"
+ENCODINGS = {"gzip": ".gz", "br": ".br"}
+
+
+def encode_columnar(columns, metadata=None):
+    """Encode a dictionary of equal length numeric columns as bytes."""
+    names = list(columns.keys())
+    arrays = [np.asarray(columns[name], dtype="<f4") for name in names]
+    n_rows = len(arrays[0]) if arrays else 0
+    if any(len(a) != n_rows for a in arrays):
+        raise ValueError("Columns must have the same length")
+
+    header = json.dumps(
+        dict(
+            n_rows=n_rows,
+            columns=names,
+            offsets=[i * n_rows * 4 for i in range(len(names))],
+            metadata=metadata or {},
+        )
+    ).encode()
+    # pad the header so the columns are aligned for float32 typed arrays
+    header = header.ljust(len(header) + (-len(header) % 4), b" ")
+    return b"".join(
+        [MAGIC, struct.pack("<I", len(header)), header, *(a.tobytes() for a in arrays)]
+    )
+
+
+def decode_columnar(data):
+    """Decode bytes from encode_columnar into the columns and the metadata."""
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("Not a columnar export")
+    (length,) = struct.unpack("<I", data[len(MAGIC) : len(MAGIC) + 4])
+    start = len(MAGIC) + 4
+    header = json.loads(data[start : start + length])
+    start += length
+    columns = {
+        name: np.frombuffer(
+            data, dtype="<f4", count=header["n_rows"], offset=start + offset
+        )
+        for name, offset in zip(header["columns"], header["offsets"])
+    }
+    return columns, header["metadata"]
+
+
+def _compress(data, encoding):
+    if encoding == "gzip":
+        # a fixed mtime keeps the output identical between runs
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "br":
+        import brotli
+
+        return brotli.compress(data)
+    raise ValueError(f"Unknown encoding: {encoding}")
+
+
+def write_columnar(path, columns, metadata=None, encodings=("gzip", "br")):
+    """Write columns to a file, along with precompressed variants. Brotli is
+    skipped if the brotli package is not installed. Returns the encodings that
+    were written."""
+    path = Path(path)
+    data = encode_columnar(columns, metadata)
+    path.write_bytes(data)
+    written = []
+    for encoding in encodings:
+        try:
+            compressed = _compress(data, encoding)
+        except ImportError:
+            continue
+        path.with_name(path.name + ENCODINGS[encoding]).write_bytes(compressed)
+        written.append(encoding)
+    return written
+
+
+def read_columnar(path):
+    return decode_columnar(Path(path).read_bytes())
@@ -1,11 +1,20 @@
+import hashlib
 import json
+import os
 from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from cartopy.io import shapereader
+from scipy import sparse
+from shapely import wkb
 from shapely.geometry import Point, Polygon, mapping
 from shapely.ops import unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from .profiling import span
 
 CA_EXTENT = (-125, -114, 32, 43)
 WESTERN_US_EXTENT = (-125, -101, 31, 50)
@@ -15,6 +24,9 @@ AMERICAS_EXTENT = (-170, -30, -60, 80)
 
 
 def get_shape_us_state(state_name):
+    # cartopy is slow to import and only needed to build a grid
+    from cartopy.io import shapereader
+
     reader = shapereader.Reader(
         shapereader.natural_earth(
             resolution="50m", category="cultural", name="admin_1_states_provinces"
@@ -56,6 +68,8 @@ def get_western_us_geometry():
 
 def get_americas_geometry():
     """Get the geometry for north and south america, except greenland."""
+    from cartopy.io import shapereader
+
     reader = shapereader.Reader(
         shapereader.natural_earth(
             resolution="50m", category="cultural", name="admin_0_countries"
@@ -80,33 +94,52 @@ def generate_grid(geometry, map_dims, grid_dims):
     xmin, xmax, ymin, ymax = map_dims
     length, width = grid_dims
 
-    # generate a grid of polygons that intersect with the provided geometry
-    polygons = {}
-    cols = list(np.arange(xmin, xmax + width, width))
-    rows = list(np.arange(ymin, ymax + length, length))
-    for x in cols[:-1]:
-        for y in rows[:-1]:
+    # generate a grid of polygons that intersect with the provided geometry. We
+    # only need to test squares that overlap with the bounds of the geometry,
+    # and a prepared geometry makes each of the intersection tests cheap.
+    cols = np.arange(xmin, xmax + width, width)[:-1]
+    rows = np.arange(ymin, ymax + length, length)[:-1]
+    bounds_xmin, bounds_ymin, bounds_xmax, bounds_ymax = geometry.bounds
+    col_idx = np.flatnonzero((cols <= bounds_xmax) & (cols + width >= bounds_xmin))
+    row_idx = np.flatnonzero((rows <= bounds_ymax) & (rows + length >= bounds_ymin))
+    prepared = prep(geometry)
+    cells = {}
+    for i in col_idx:
+        for j in row_idx:
+            x, y = cols[i], rows[j]
             polygon = Polygon(
                 [(x, y), (x + width, y), (x + width, y + length), (x, y + length)]
             )
-            if geometry.intersects(polygon):
-                polygons[f"{x}_{y}"] = polygon
+            if prepared.intersects(polygon):
+                cells[(i, j)] = (f"{x}_{y}", polygon)
 
     # lets remove all polygons that do not have any neighbors to avoid
     # having a bunch of small polygons that are not connected to the rest of the
-    # grid. O(n^2)
-    for key, polygon in list(polygons.items()):
-        neighbors = [
-            neighbor
-            for neighbor in polygons.values()
-            if neighbor != polygon and polygon.intersects(neighbor)
-        ]
-        if not neighbors:
-            del polygons[key]
-
+    # grid. Neighbors share an edge or a corner, so we only need to look up the
+    # surrounding (col, row) offsets of each square.
+    offsets = [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1) if di or dj]
+    polygons = {
+        key: polygon
+        for (i, j), (key, polygon) in cells.items()
+        if any((i + di, j + dj) in cells for di, dj in offsets)
+    }
     return polygons
 
 
+# bump this when the layout of the cached grid files or the grid generation changes
+GRID_CACHE_VERSION = 1
+GRID_CACHE_DIR = Path(
+    os.environ.get(
+        "BIRDCALL_GRID_CACHE", Path.home() / ".cache" / "birdcall_distribution" / "grid"
+    )
+)
+REGION_SHAPEFILES = {
+    "ca": "admin_1_states_provinces",
+    "western_us": "admin_1_states_provinces",
+    "americas": "admin_0_countries",
+}
+
+
 @dataclass
 class Grid:
     region: str
@@ -114,23 +147,173 @@ class Grid:
     extent: tuple[float, float, float, float]
     grid_size: int
     grid: dict[str, Polygon]
+    # (col, row) position of each cell in grid order, None if not a lattice
+    indices: np.ndarray = None
+    # queen adjacency in the sorted order of get_adjacency_mapping
+    adjacency: sparse.csr_matrix = None
+
+
+def _build_grid_meta(region, grid_size):
+    """Build the grid metadata for a region from the natural earth shapefiles."""
+    with span("geo.load_shapefiles", region=region):
+        if region == "western_us":
+            geometry = get_western_us_geometry()
+            extent = WESTERN_US_EXTENT
+        elif region == "ca":
+            geometry = get_california_geometry()
+            extent = CA_EXTENT
+        elif region == "americas":
+            geometry = get_americas_geometry()
+            extent = AMERICAS_EXTENT
+        else:
+            raise ValueError("Unknown region")
+    with span("geo.generate_grid", region=region, grid_size=grid_size):
+        grid = generate_grid(geometry, extent, (grid_size, grid_size))
+    with span("geo.adjacency", region=region, grid_size=grid_size):
+        indices = get_lattice_indices(list(grid.values()))
+        adjacency, _ = generate_grid_adjacency_matrix(grid)
+    return Grid(region, geometry, extent, grid_size, grid, indices, adjacency)
+
+
+def _natural_earth_path(name, resolution="50m", category="cultural"):
+    """Find a natural earth shapefile in the directories cartopy reads them
+    from, without importing cartopy or downloading the file. Returns None if it
+    has not been downloaded."""
+    shapefile = Path(
+        "shapefiles", "natural_earth", category, f"ne_{resolution}_{name}.shp"
+    )
+    data_dirs = [
+        os.environ.get("CARTOPY_DATA_DIR"),
+        Path(os.environ.get("XDG_DATA_HOME", Path.home() / ".local" / "share"))
+        / "cartopy",
+    ]
+    for data_dir in data_dirs:
+        if data_dir and (Path(data_dir) / shapefile).exists():
+            return Path(data_dir) / shapefile
+    return None
+
+
+def _natural_earth_version(name, resolution="50m", category="cultural"):
+    """Identify the version of a natural earth shapefile by its path, size and
+    modification time, or None if it has not been downloaded."""
+    path = _natural_earth_path(name, resolution=resolution, category=category)
+    if path is None:
+        return None
+    stat = path.stat()
+    return f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def grid_cache_path(region, grid_size, cache_dir=None):
+    """Get the path to the cached grid, addressed by the region, the grid size
+    and the version of the shapefile the region is built from. Returns None if
+    the shapefile has not been downloaded."""
+    if region not in REGION_SHAPEFILES:
+        raise ValueError("Unknown region")
+    cache_dir = Path(cache_dir or GRID_CACHE_DIR)
+    source = _natural_earth_version(REGION_SHAPEFILES[region])
+    if source is None:
+        return None
+    digest = hashlib.sha256(f"{region}:{grid_size}:{source}".encode()).hexdigest()
+    return cache_dir / f"{region}_{grid_size}_v{GRID_CACHE_VERSION}_{digest[:16]}.npz"
+
+
+def latest_grid_cache_path(region, grid_size, cache_dir=None):
+    """Get the most recently written cached grid for a region and grid size, or
+    None if there is none."""
+    cache_dir = Path(cache_dir or GRID_CACHE_DIR)
+    paths = list(cache_dir.glob(f"{region}_{grid_size}_v{GRID_CACHE_VERSION}_*.npz"))
+    return max(paths, key=lambda p: p.stat().st_mtime_ns) if paths else None
+
+
+def save_grid_meta(grid_meta, path):
+    """Save grid metadata to a npz file, with geometries encoded as WKB."""
+    polygons = [wkb.dumps(polygon) for polygon in grid_meta.grid.values()]
+    W = grid_meta.adjacency
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first so concurrent readers never see a
+    # partially written cache
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            region=np.array(grid_meta.region),
+            grid_size=np.array(grid_meta.grid_size),
+            extent=np.array(grid_meta.extent),
+            geometry=np.frombuffer(wkb.dumps(grid_meta.geometry), dtype=np.uint8),
+            keys=np.array(list(grid_meta.grid.keys()), dtype=str),
+            polygons=np.frombuffer(b"".join(polygons), dtype=np.uint8),
+            polygon_offsets=np.cumsum([0] + [len(p) for p in polygons]),
+            indices=(
+                grid_meta.indices
+                if grid_meta.indices is not None
+                else np.zeros((0, 2), dtype=int)
+            ),
+            adjacency_shape=np.array(W.shape),
+            adjacency_indptr=W.indptr,
+            adjacency_indices=W.indices,
+            adjacency_data=W.data,
+        )
+    os.replace(tmp_path, path)
+
+
+def load_grid_meta(path):
+    """Load grid metadata from a npz file written by save_grid_meta."""
+    with np.load(path) as data:
+        blob = data["polygons"].tobytes()
+        offsets = data["polygon_offsets"]
+        grid = {
+            str(key): wkb.loads(blob[start:end])
+            for key, start, end in zip(data["keys"], offsets[:-1], offsets[1:])
+        }
+        indices = data["indices"] if len(data["indices"]) else None
+        adjacency = sparse.csr_matrix(
+            (
+                data["adjacency_data"],
+                data["adjacency_indices"],
+                data["adjacency_indptr"],
+            ),
+            shape=tuple(data["adjacency_shape"]),
+        )
+        return Grid(
+            str(data["region"]),
+            wkb.loads(data["geometry"].tobytes()),
+            tuple(data["extent"].tolist()),
+            data["grid_size"].item(),
+            grid,
+            indices,
+            adjacency,
+        )
 
 
-def get_grid_meta(region, grid_size):
-    """Get the grid metadata for a region."""
-    if region == "western_us":
-        geometry = get_western_us_geometry()
-        extent = WESTERN_US_EXTENT
-    elif region == "ca":
-        geometry = get_california_geometry()
-        extent = CA_EXTENT
-    elif region == "americas":
-        geometry = get_americas_geometry()
-        extent = AMERICAS_EXTENT
-    else:
-        raise ValueError("Unknown region")
-    grid = generate_grid(geometry, extent, (grid_size, grid_size))
-    return Grid(region, geometry, extent, grid_size, grid)
+@lru_cache(maxsize=16, typed=True)
+def _cached_grid_meta(region, grid_size):
+    path = grid_cache_path(region, grid_size)
+    if path is None:
+        # the shapefile is not on disk, e.g. when offline, so use the grid that
+        # was cached most recently instead of downloading it
+        path = latest_grid_cache_path(region, grid_size)
+    if path is not None and path.exists():
+        with span("geo.load_grid_cache", region=region, grid_size=grid_size):
+            return load_grid_meta(path)
+    grid_meta = _build_grid_meta(region, grid_size)
+    # the shapefile has been downloaded while building the grid
+    path = grid_cache_path(region, grid_size)
+    if path is not None:
+        save_grid_meta(grid_meta, path)
+    return grid_meta
+
+
+def get_grid_meta(region, grid_size, cache=True):
+    """Get the grid metadata for a region.
+
+    The grid is cached on disk and in memory, since it is expensive to read
+    and union the shapefiles for a region. The cached object is shared between
+    callers, so it should not be modified.
+    """
+    if not cache:
+        return _build_grid_meta(region, grid_size)
+    return _cached_grid_meta(region, grid_size)
 
 
 def _maybe_get_polygon_pair(polygons, point):
@@ -141,14 +324,135 @@ def _maybe_get_polygon_pair(polygons, point):
     return None, None
 
 
+def _rectangle_bounds(polygons):
+    """Get the bounds of each polygon, or None if any of them are not
+    axis-aligned rectangles."""
+    if not polygons:
+        return None
+    bounds = np.array([p.bounds for p in polygons])
+    areas = np.array([p.area for p in polygons])
+    minx, miny, maxx, maxy = bounds.T
+    is_rectangle = all(
+        p.geom_type == "Polygon" and len(p.exterior.coords) == 5 and not p.interiors
+        for p in polygons
+    )
+    if not is_rectangle or not np.allclose(areas, (maxx - minx) * (maxy - miny)):
+        return None
+    return bounds
+
+
+def get_lattice_indices(polygons):
+    """Get the integer (col, row) position of each polygon in a regular lattice
+    of squares. Returns None if the polygons do not form a lattice."""
+    bounds = _rectangle_bounds(polygons)
+    if bounds is None:
+        return None
+    minx, miny, maxx, maxy = bounds.T
+    width, length = maxx - minx, maxy - miny
+    if not (np.allclose(width, width[0]) and np.allclose(length, length[0])):
+        return None
+    cols = (minx - minx.min()) / width[0]
+    rows = (miny - miny.min()) / length[0]
+    if not (np.allclose(cols, np.round(cols)) and np.allclose(rows, np.round(rows))):
+        return None
+    indices = np.stack([np.round(cols), np.round(rows)], axis=1).astype(int)
+    if len(np.unique(indices, axis=0)) != len(polygons):
+        return None
+    return indices
+
+
+def _group_edges(values, tol):
+    """Group values that are equal up to a tolerance. Returns the smallest
+    value of each group in sorted order, and the group of each value."""
+    unique = np.unique(values)
+    starts = np.concatenate([[True], np.diff(unique) > tol])
+    groups = np.cumsum(starts) - 1
+    return unique[starts], groups[np.searchsorted(unique, values)]
+
+
+def _lattice_lookup(polygons, lon, lat):
+    """Find the index of the cell containing each point in a lattice of
+    axis-aligned rectangles. Returns None if the polygons are not a lattice.
+
+    The containment check is strict, so points on the edge of a cell are not
+    assigned to any cell, matching the behavior of `Polygon.contains`.
+    """
+    bounds = _rectangle_bounds(polygons)
+    if bounds is None:
+        return None
+    minx, miny, maxx, maxy = bounds.T
+    # edges computed in floating point, e.g. on a 1/3 degree grid, can differ
+    # in the last few bits between neighboring cells
+    tol = 1e-9 * max(np.abs(bounds).max(), 1)
+
+    # every column (and row) of cells must share the same edges and must not
+    # overlap with the next one
+    col_edges, cols = _group_edges(minx, tol)
+    row_edges, rows = _group_edges(miny, tol)
+    col_max = np.zeros(len(col_edges))
+    row_max = np.zeros(len(row_edges))
+    col_max[cols] = maxx
+    row_max[rows] = maxy
+    if (
+        np.any(np.abs(col_max[cols] - maxx) > tol)
+        or np.any(np.abs(row_max[rows] - maxy) > tol)
+        or np.any(col_edges[1:] < col_max[:-1] - tol)
+        or np.any(row_edges[1:] < row_max[:-1] - tol)
+    ):
+        return None
+    table = np.full((len(col_edges), len(row_edges)), -1)
+    table[cols, rows] = np.arange(len(polygons))
+    if np.count_nonzero(table >= 0) != len(polygons):
+        # duplicate cells
+        return None
+
+    col = np.searchsorted(col_edges, lon, side="left") - 1
+    row = np.searchsorted(row_edges, lat, side="left") - 1
+    valid = (col >= 0) & (row >= 0)
+    col, row = np.where(valid, col, 0), np.where(valid, row, 0)
+    valid &= (lon < col_max[col]) & (lat < row_max[row])
+    return np.where(valid, table[col, row], -1)
+
+
+def _strtree_lookup(polygons, lon, lat):
+    """Find the index of the first polygon that contains each point using a
+    spatial index."""
+    tree = STRtree(polygons)
+    # shapely>=2 returns indices from a query, while 1.8 returns geometries
+    index_by_id = {id(p): i for i, p in enumerate(polygons)}
+    result = np.full(len(lon), -1)
+    for i, (x, y) in enumerate(zip(lon, lat)):
+        point = Point(x, y)
+        candidates = sorted(
+            int(c) if isinstance(c, (int, np.integer)) else index_by_id[id(c)]
+            for c in tree.query(point)
+        )
+        for j in candidates:
+            if polygons[j].contains(point):
+                result[i] = j
+                break
+    return result
+
+
 def add_lonlat_columns(df, grid):
     """Add a grid columns to a dataframe."""
-    pair = df.apply(
-        lambda row: _maybe_get_polygon_pair(grid, Point(row.longitude, row.latitude)),
-        axis="columns",
-        result_type="expand",
+    keys = list(grid.keys())
+    polygons = list(grid.values())
+    lon = df.longitude.values.astype(float)
+    lat = df.latitude.values.astype(float)
+
+    idx = _lattice_lookup(polygons, lon, lat)
+    if idx is None:
+        idx = _strtree_lookup(polygons, lon, lat)
+
+    pair = pd.DataFrame(
+        {
+            "grid_id": [keys[i] if i >= 0 else None for i in idx],
+            "grid": [polygons[i] if i >= 0 else None for i in idx],
+        },
+        index=df.index,
+        dtype=object,
     )
-    pair.columns = ["grid_id", "grid"]
     df = pd.concat([df, pair], axis="columns")
     return df
 
@@ -166,6 +470,73 @@ def generate_grid_adjacency_list(polygons):
     return adj
 
 
+def _lattice_adjacency(indices, queen=True):
+    """Find pairs of neighboring cells from their (col, row) lattice indices."""
+    offsets = [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1) if di or dj]
+    if not queen:
+        offsets = [(di, dj) for di, dj in offsets if not (di and dj)]
+
+    # pad the table by one cell so every offset stays in bounds
+    cols, rows = indices.T + 1
+    table = np.full((cols.max() + 2, rows.max() + 2), -1)
+    table[cols, rows] = np.arange(len(indices))
+    src, dst = [], []
+    for di, dj in offsets:
+        neighbor = table[cols + di, rows + dj]
+        found = neighbor >= 0
+        src.append(np.flatnonzero(found))
+        dst.append(neighbor[found])
+    return np.concatenate(src), np.concatenate(dst)
+
+
+def _strtree_adjacency(polygons, queen=True):
+    """Find pairs of intersecting polygons using a spatial index. When queen is
+    False, polygons that only share a corner are not neighbors."""
+    tree = STRtree(polygons)
+    index_by_id = {id(p): i for i, p in enumerate(polygons)}
+    src, dst = [], []
+    for i, polygon in enumerate(polygons):
+        for c in tree.query(polygon):
+            j = int(c) if isinstance(c, (int, np.integer)) else index_by_id[id(c)]
+            if i == j or not polygon.intersects(polygons[j]):
+                continue
+            if not queen and polygon.intersection(polygons[j]).length == 0:
+                continue
+            src.append(i)
+            dst.append(j)
+    return np.array(src, dtype=int), np.array(dst, dtype=int)
+
+
+def generate_grid_adjacency_matrix(polygons, queen=True, dense=False):
+    """Generate a sparse adjacency matrix for the same grid of polygons we
+    create, along with the mapping from grid keys to indices in the matrix.
+
+    Neighbors are derived from the lattice indices of the grid, falling back to
+    intersection tests if the grid is not a regular lattice. Queen neighbors
+    share an edge or a corner, which matches `generate_grid_adjacency_list`,
+    while rook neighbors only share an edge. Set dense to get a numpy array.
+    """
+    mapping = get_adjacency_mapping(polygons)
+    keys = list(polygons.keys())
+    values = list(polygons.values())
+
+    indices = get_lattice_indices(values)
+    if indices is not None:
+        src, dst = _lattice_adjacency(indices, queen=queen)
+    else:
+        src, dst = _strtree_adjacency(values, queen=queen)
+
+    # reorder from the grid order into the sorted order of the mapping
+    order = np.array([mapping[key] for key in keys], dtype=int)
+    n = len(mapping)
+    W = sparse.csr_matrix(
+        (np.ones(len(src), dtype=int), (order[src], order[dst])), shape=(n, n)
+    )
+    if dense:
+        W = W.toarray()
+    return W, mapping
+
+
 def get_adjacency_mapping(adjacency_list):
     """Get a mapping from grid keys to indices in the adjacency matrix."""
     keys = sorted(adjacency_list.keys())
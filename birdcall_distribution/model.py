@@ -1,7 +1,17 @@
+import aesara.tensor as at
 import numpy as np
+import pandas as pd
 import pymc as pm
-
-from birdcall_distribution.data import prepare_scaled_data
+import scipy.linalg
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+
+from birdcall_distribution.data import (
+    FEATURE_SETS,
+    ModelData,
+    Scaler,
+    prepare_scaled_data,
+)
 from birdcall_distribution.geo import get_modis_land_cover_name
 
 
@@ -21,71 +31,141 @@ def _scaled_data_old(prep_df):
 
 
 def _scaled_data(prep_df):
-    covariate_cols = prep_df.columns[5:-1]
-    log_cols = [c for c in covariate_cols if "population" in c or "land_cover" in c]
-    return prepare_scaled_data(prep_df, covariate_cols, log_cols, intercept=False)
+    """Scale every covariate of a prepared dataframe, with a column per feature
+    of the covariate models. Used by the notebooks to label coefficients."""
+    scaler = Scaler.fit(prep_df, FEATURE_SETS["all"])
+    return pd.DataFrame(scaler.transform(prep_df), columns=scaler.features)
+
+
+def _model_data(data, W=None):
+    """Build the model data from a prepared dataframe, unless it already is."""
+    if isinstance(data, ModelData):
+        return data
+    return ModelData.from_dataframe(data, W)
+
+
+def _observed(data, fill_value=0):
+    """Observed counts as mutable data, so the counts of another species can be
+    swapped in with pm.set_data without rebuilding the model."""
+    return pm.MutableData(
+        "y_observed",
+        np.ma.masked_invalid(data.y).filled(fill_value),
+        dims="obs_idx",
+    )
 
 
-def _coords(prep_df, scaled_data_df):
-    species_cat = prep_df.primary_label.astype("category")
+def _coords(data):
     snake_case = lambda s: s.replace(" ", "_").replace("/", "_").lower()
     norm = (
         lambda c: f"{c}_{snake_case(get_modis_land_cover_name(c))}"
         if "land_cover" in c
         else c
     )
-    features = [norm(c) for c in scaled_data_df.columns.values]
+    features = [norm(c) for c in data.features]
     coords = dict(
         features_idx=features,
-        species_idx=species_cat.cat.categories,
-        adj_idx=sorted(prep_df.index.unique()),
-        obs_idx=np.arange(prep_df.shape[0]),
+        species_idx=data.species,
+        adj_idx=np.arange(data.covariates.shape[0]),
+        obs_idx=np.arange(len(data.y)),
     )
     return coords
 
 
-def make_varying_intercept_model(prep_df, *args, **kwargs):
+def sparse_car(name, W, alpha=None, tau=1.0, dims=None):
+    """Zero-mean CAR prior that keeps the adjacency matrix sparse.
+
+    The log-density is the same as `pm.CAR`, but the quadratic form is computed
+    over the edges of W and the log-determinant uses the eigenvalues of
+    D^{-1/2} W D^{-1/2}, which are computed once when the model is built. This
+    makes each gradient evaluation linear in the number of edges instead of
+    quadratic in the number of cells.
+
+    If alpha is None, this is the intrinsic CAR (ICAR) prior, which has a soft
+    sum-to-zero constraint for identifiability.
+    https://mc-stan.org/users/documentation/case-studies/icar_stan.html
+
+    The cells are the last dimension of dims, and any leading dimensions are
+    independent CAR vectors, e.g. one per species. In that case alpha and tau
+    may have the shape of the leading dimensions.
+    """
+    W = scipy.sparse.coo_matrix(W)
+    n = W.shape[0]
+    degree = np.asarray(W.sum(axis=1)).ravel()
+    if np.any(degree == 0):
+        raise ValueError("Every cell in W must have at least one neighbor")
+    # the quadratic forms are symmetric, so we only need each edge once
+    upper = W.row < W.col
+    src, dst = W.row[upper], W.col[upper]
+
+    if dims is None:
+        phi = pm.Flat(name, shape=n)
+    else:
+        phi = pm.Flat(name, dims=dims)
+
+    if alpha is None:
+        # the precision matrix has one zero eigenvalue per connected component
+        n_components, _ = connected_components(W)
+        quad = pm.math.sum((phi[..., src] - phi[..., dst]) ** 2, axis=-1)
+        logp = 0.5 * ((n - n_components) * pm.math.log(tau) - tau * quad)
+        logp += pm.logp(
+            pm.Normal.dist(mu=0, sigma=0.001 * n), pm.math.sum(phi, axis=-1)
+        )
+    else:
+        dinv_sqrt = scipy.sparse.diags(1 / np.sqrt(degree))
+        lam = scipy.linalg.eigvalsh((dinv_sqrt @ W @ dinv_sqrt).toarray())
+        alpha = at.shape_padright(at.as_tensor_variable(alpha))
+        logdet = pm.math.sum(pm.math.log(1 - alpha * lam), axis=-1)
+        quad = pm.math.sum(degree * phi**2, axis=-1) - 2 * alpha[
+            ..., 0
+        ] * pm.math.sum(phi[..., src] * phi[..., dst], axis=-1)
+        logp = 0.5 * (n * pm.math.log(tau) + logdet - tau * quad)
+    pm.Potential(f"{name}_car", pm.math.sum(logp))
+    return phi
+
+
+def _car(name, W, alpha, tau, sparse=False, dims=None):
+    """CAR prior for the spatial random effects, using sparse_car if set."""
+    if sparse:
+        return sparse_car(name, W, alpha=alpha, tau=tau, dims=dims)
+    if scipy.sparse.issparse(W):
+        W = W.toarray()
+    return pm.CAR(name, mu=np.zeros(W.shape[0]), tau=tau, alpha=alpha, W=W, dims=dims)
+
+
+def make_varying_intercept_model(data, W=None, *args, **kwargs):
     """Intercept-only model"""
-    scaled_data_df = _scaled_data(prep_df)
-    species_cat = prep_df.primary_label.astype("category")
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        species_idx = pm.ConstantData(
-            "species_idx", species_cat.cat.codes, dims="obs_idx"
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
         intercept = pm.Normal("intercept", mu=0, tau=1e-4, dims="species_idx")
         mu = pm.Deterministic("mu", pm.math.exp(intercept[species_idx]), dims="obs_idx")
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
 
     return model
 
 
-def make_varying_intercept_car_model(prep_df, W, *args, **kwargs):
+def make_varying_intercept_car_model(data, W=None, *args, sparse=False, **kwargs):
     """Model intercept per species and CAR for spatial varying effects."""
-    scaled_data_df = _scaled_data(prep_df)
-    species_cat = prep_df.primary_label.astype("category")
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        species_idx = pm.ConstantData(
-            "species_idx", species_cat.cat.codes, dims="obs_idx"
-        )
-        adj_idx = pm.ConstantData(
-            "adj_idx", prep_df.index.values.astype(int), dims="obs_idx"
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
 
         alpha = pm.Beta("alpha", 5, 1)
         sigma_phi = pm.Uniform("sigma_phi", 0, 20)
-        phi = pm.CAR(
+        phi = _car(
             "phi",
-            mu=np.zeros(W.shape[0]),
-            tau=1 / sigma_phi,
+            data.adjacency,
             alpha=alpha,
-            W=W,
+            tau=1 / sigma_phi,
+            sparse=sparse,
             dims="adj_idx",
         )
         # hyperpriors for intercept
@@ -103,29 +183,27 @@ def make_varying_intercept_car_model(prep_df, W, *args, **kwargs):
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
     return model
 
 
-def make_pooled_intercept_car_model(prep_df, W, *args, **kwargs):
+def make_pooled_intercept_car_model(data, W=None, *args, sparse=False, **kwargs):
     """Model intercept per species and CAR for spatial varying effects."""
-    scaled_data_df = _scaled_data(prep_df)
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        adj_idx = pm.ConstantData(
-            "adj_idx", prep_df.index.values.astype(int), dims="obs_idx"
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
 
         alpha = pm.Beta("alpha", 5, 1)
         tau_phi = pm.Gamma("tau_phi", 1e-3, 1e-3)
-        phi = pm.CAR(
+        phi = _car(
             "phi",
-            mu=np.zeros(W.shape[0]),
-            tau=tau_phi,
+            data.adjacency,
             alpha=alpha,
-            W=W,
+            tau=tau_phi,
+            sparse=sparse,
             dims="adj_idx",
         )
         intercept = pm.Normal("intercept", mu=0, tau=1e-4)
@@ -135,24 +213,20 @@ def make_pooled_intercept_car_model(prep_df, W, *args, **kwargs):
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
     return model
 
 
-def make_varying_intercept_pooled_covariate_model(prep_df, *args, **kwargs):
+def make_varying_intercept_pooled_covariate_model(data, W=None, *args, **kwargs):
     """Model intercept per species and shared covariate"""
-    scaled_data_df = _scaled_data(prep_df)
-    species_cat = prep_df.primary_label.astype("category")
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        species_idx = pm.ConstantData(
-            "species_idx", species_cat.cat.codes, dims="obs_idx"
-        )
-        X = pm.ConstantData(
-            "X", scaled_data_df.values, dims=("obs_idx", "features_idx")
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
 
         intercept_bar = pm.Normal("intercept_bar", mu=0, sigma=1.5)
         intercept_sigma = pm.Exponential("intercept_sigma", 1)
@@ -166,26 +240,27 @@ def make_varying_intercept_pooled_covariate_model(prep_df, *args, **kwargs):
         )
         mu = pm.Deterministic(
             "mu",
-            pm.math.exp(intercept[species_idx] + pm.math.sum(X * betas, axis=1)),
+            pm.math.exp(
+                intercept[species_idx] + pm.math.sum(X[adj_idx] * betas, axis=1)
+            ),
             dims="obs_idx",
         )
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
     return model
 
 
-def make_pooled_intercept_pooled_covariate_model(prep_df, *args, **kwargs):
+def make_pooled_intercept_pooled_covariate_model(data, W=None, *args, **kwargs):
     """Model intercept per species and shared covariate"""
-    scaled_data_df = _scaled_data(prep_df)
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        X = pm.ConstantData(
-            "X", scaled_data_df.values, dims=("obs_idx", "features_idx")
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
 
         intercept = pm.Normal("intercept", mu=0, tau=1e-4)
         betas_bar = pm.Normal("betas_bar", mu=0, sigma=1.5)
@@ -195,30 +270,26 @@ def make_pooled_intercept_pooled_covariate_model(prep_df, *args, **kwargs):
         )
         mu = pm.Deterministic(
             "mu",
-            pm.math.exp(intercept + pm.math.sum(X * betas, axis=1)),
+            pm.math.exp(intercept + pm.math.sum(X[adj_idx] * betas, axis=1)),
             dims="obs_idx",
         )
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
     return model
 
 
-def make_pooled_intercept_varying_covariate_model(prep_df, *args, **kwargs):
+def make_pooled_intercept_varying_covariate_model(data, W=None, *args, **kwargs):
     """Model intercept per species and shared covariate"""
-    scaled_data_df = _scaled_data(prep_df)
-    species_cat = prep_df.primary_label.astype("category")
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        species_idx = pm.ConstantData(
-            "species_idx", species_cat.cat.codes, dims="obs_idx"
-        )
-        X = pm.ConstantData(
-            "X", scaled_data_df.values, dims=("obs_idx", "features_idx")
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
 
         intercept = pm.Normal("intercept", mu=0, tau=1e-4)
         betas_bar = pm.Normal("betas_bar", mu=0, sigma=1.5)
@@ -231,30 +302,28 @@ def make_pooled_intercept_varying_covariate_model(prep_df, *args, **kwargs):
         )
         mu = pm.Deterministic(
             "mu",
-            pm.math.exp(intercept + pm.math.sum(X * betas[species_idx], axis=1)),
+            pm.math.exp(
+                intercept + pm.math.sum(X[adj_idx] * betas[species_idx], axis=1)
+            ),
             dims="obs_idx",
         )
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
     return model
 
 
-def make_varying_intercept_varying_covariate_model(prep_df, *args, **kwargs):
+def make_varying_intercept_varying_covariate_model(data, W=None, *args, **kwargs):
     """Model intercept per species and shared covariate"""
-    scaled_data_df = _scaled_data(prep_df)
-    species_cat = prep_df.primary_label.astype("category")
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        species_idx = pm.ConstantData(
-            "species_idx", species_cat.cat.codes, dims="obs_idx"
-        )
-        X = pm.ConstantData(
-            "X", scaled_data_df.values, dims=("obs_idx", "features_idx")
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
 
         intercept_bar = pm.Normal("intercept_bar", mu=0, sigma=1.5)
         intercept_sigma = pm.Exponential("intercept_sigma", 1)
@@ -272,42 +341,38 @@ def make_varying_intercept_varying_covariate_model(prep_df, *args, **kwargs):
         mu = pm.Deterministic(
             "mu",
             pm.math.exp(
-                intercept[species_idx] + pm.math.sum(X * betas[species_idx], axis=1)
+                intercept[species_idx]
+                + pm.math.sum(X[adj_idx] * betas[species_idx], axis=1)
             ),
             dims="obs_idx",
         )
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
     return model
 
 
-def make_pooled_intercept_varying_covariate_car_model(prep_df, W, *args, **kwargs):
-    scaled_data_df = _scaled_data(prep_df)
-    species_cat = prep_df.primary_label.astype("category")
+def make_pooled_intercept_varying_covariate_car_model(
+    data, W=None, *args, sparse=False, **kwargs
+):
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        species_idx = pm.ConstantData(
-            "species_idx", species_cat.cat.codes, dims="obs_idx"
-        )
-        adj_idx = pm.ConstantData(
-            "adj_idx", prep_df.index.values.astype(int), dims="obs_idx"
-        )
-        X = pm.ConstantData(
-            "X", scaled_data_df.values, dims=("obs_idx", "features_idx")
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
 
         alpha = pm.Beta("alpha", 5, 1)
         sigma_phi = pm.Uniform("sigma_phi", 0, 20)
-        phi = pm.CAR(
+        phi = _car(
             "phi",
-            mu=np.zeros(W.shape[0]),
-            tau=1 / sigma_phi,
+            data.adjacency,
             alpha=alpha,
-            W=W,
+            tau=1 / sigma_phi,
+            sparse=sparse,
             dims="adj_idx",
         )
         intercept = pm.Normal("intercept", mu=0, tau=1e-4)
@@ -322,36 +387,38 @@ def make_pooled_intercept_varying_covariate_car_model(prep_df, W, *args, **kwarg
         mu = pm.Deterministic(
             "mu",
             pm.math.exp(
-                intercept + pm.math.sum(X * betas[species_idx], axis=1) + phi[adj_idx]
+                intercept
+                + pm.math.sum(X[adj_idx] * betas[species_idx], axis=1)
+                + phi[adj_idx]
             ),
             dims="obs_idx",
         )
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
     return model
 
 
-def make_pooled_intercept_pooled_covariate_car_model(prep_df, W, *args, **kwargs):
-    scaled_data_df = _scaled_data(prep_df)
+def make_pooled_intercept_pooled_covariate_car_model(
+    data, W=None, *args, sparse=False, **kwargs
+):
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        adj_idx = pm.ConstantData(
-            "adj_idx", prep_df.index.values.astype(int), dims="obs_idx"
-        )
-        X = pm.ConstantData("X", scaled_data_df, dims=("obs_idx", "features_idx"))
+    with pm.Model(coords=_coords(data)) as model:
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
 
         alpha = pm.Beta("alpha", 5, 1)
         tau_phi = pm.Gamma("tau_phi", 1, 1)
-        phi = pm.CAR(
+        phi = _car(
             "phi",
-            mu=np.zeros(W.shape[0]),
-            tau=tau_phi,
+            data.adjacency,
             alpha=alpha,
-            W=W,
+            tau=tau_phi,
+            sparse=sparse,
             dims="adj_idx",
         )
 
@@ -366,42 +433,39 @@ def make_pooled_intercept_pooled_covariate_car_model(prep_df, W, *args, **kwargs
         # print(phi[adj_idx].eval().shape)
         mu = pm.Deterministic(
             "mu",
-            pm.math.exp(intercept + pm.math.sum(X * betas, axis=1) + phi[adj_idx]),
+            pm.math.exp(
+                intercept + pm.math.sum(X[adj_idx] * betas, axis=1) + phi[adj_idx]
+            ),
             dims="obs_idx",
         )
         # print(mu.eval().shape)
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(1e-3),
+            observed=_observed(data, fill_value=1e-3),
             dims="obs_idx",
         )
     return model
 
 
-def make_varying_intercept_pooled_covariate_car_model(prep_df, W, *args, **kwargs):
-    scaled_data_df = _scaled_data(prep_df)
-    species_cat = prep_df.primary_label.astype("category")
+def make_varying_intercept_pooled_covariate_car_model(
+    data, W=None, *args, sparse=False, **kwargs
+):
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        species_idx = pm.ConstantData(
-            "species_idx", species_cat.cat.codes, dims="obs_idx"
-        )
-        adj_idx = pm.ConstantData(
-            "adj_idx", prep_df.index.values.astype(int), dims="obs_idx"
-        )
-        X = pm.ConstantData(
-            "X", scaled_data_df.values, dims=("obs_idx", "features_idx")
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
 
         alpha = pm.Beta("alpha", 5, 1)
         tau_phi = pm.Gamma("tau_phi", 1e-3, 1e-3)
-        phi = pm.CAR(
+        phi = _car(
             "phi",
-            mu=np.zeros(W.shape[0]),
-            tau=tau_phi,
+            data.adjacency,
             alpha=alpha,
-            W=W,
+            tau=tau_phi,
+            sparse=sparse,
             dims="adj_idx",
         )
 
@@ -421,42 +485,39 @@ def make_varying_intercept_pooled_covariate_car_model(prep_df, W, *args, **kwarg
         mu = pm.Deterministic(
             "mu",
             pm.math.exp(
-                intercept[species_idx] + pm.math.sum(X * betas, axis=1) + phi[adj_idx]
+                intercept[species_idx]
+                + pm.math.sum(X[adj_idx] * betas, axis=1)
+                + phi[adj_idx]
             ),
             dims="obs_idx",
         )
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
             dims="obs_idx",
         )
     return model
 
 
-def make_varying_intercept_varying_covariate_car_model(prep_df, W, *args, **kwargs):
-    scaled_data_df = _scaled_data(prep_df)
-    species_cat = prep_df.primary_label.astype("category")
+def make_varying_intercept_varying_covariate_car_model(
+    data, W=None, *args, sparse=False, **kwargs
+):
+    data = _model_data(data, W)
 
-    with pm.Model(coords=_coords(prep_df, scaled_data_df)) as model:
-        species_idx = pm.ConstantData(
-            "species_idx", species_cat.cat.codes, dims="obs_idx"
-        )
-        adj_idx = pm.ConstantData(
-            "adj_idx", prep_df.index.values.astype(int), dims="obs_idx"
-        )
-        X = pm.ConstantData(
-            "X", scaled_data_df.values, dims=("obs_idx", "features_idx")
-        )
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
 
         alpha = pm.Beta("alpha", 5, 1)
         sigma_phi = pm.Uniform("sigma_phi", 0, 20)
-        phi = pm.CAR(
+        phi = _car(
             "phi",
-            mu=np.zeros(W.shape[0]),
-            tau=1 / sigma_phi**2,
+            data.adjacency,
             alpha=alpha,
-            W=W,
+            tau=1 / sigma_phi**2,
+            sparse=sparse,
             dims="adj_idx",
         )
         intercept_bar = pm.Normal("intercept_bar", mu=0, sigma=1.5)
@@ -479,7 +540,7 @@ def make_varying_intercept_varying_covariate_car_model(prep_df, W, *args, **kwar
             "mu",
             pm.math.exp(
                 intercept[species_idx]
-                + pm.math.sum(X * betas[species_idx], axis=1)
+                + pm.math.sum(X[adj_idx] * betas[species_idx], axis=1)
                 + phi[adj_idx]
             ),
             dims="obs_idx",
@@ -487,7 +548,84 @@ def make_varying_intercept_varying_covariate_car_model(prep_df, W, *args, **kwar
         pm.Poisson(
             "y",
             mu=mu,
-            observed=np.ma.masked_invalid(prep_df.y.values).filled(0),
+            observed=_observed(data),
+            dims="obs_idx",
+        )
+    return model
+
+
+def make_unpooled_intercept_car_model(data, W=None, *args, **kwargs):
+    """Independent intercept and CAR random effects for each species, fit
+    jointly. This is the same as fitting make_pooled_intercept_car_model to
+    each species separately, but the model is only compiled and tuned once.
+    """
+    data = _model_data(data, W)
+
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+
+        alpha = pm.Beta("alpha", 5, 1, dims="species_idx")
+        tau_phi = pm.Gamma("tau_phi", 1e-3, 1e-3, dims="species_idx")
+        phi = sparse_car(
+            "phi",
+            data.adjacency,
+            alpha=alpha,
+            tau=tau_phi,
+            dims=("species_idx", "adj_idx"),
+        )
+        intercept = pm.Normal("intercept", mu=0, tau=1e-4, dims="species_idx")
+        mu = pm.Deterministic(
+            "mu",
+            pm.math.exp(intercept[species_idx] + phi[species_idx, adj_idx]),
+            dims="obs_idx",
+        )
+        pm.Poisson(
+            "y",
+            mu=mu,
+            observed=_observed(data),
+            dims="obs_idx",
+        )
+    return model
+
+
+def make_unpooled_intercept_unpooled_covariate_car_model(data, W=None, *args, **kwargs):
+    """Independent intercept, covariates and CAR random effects for each
+    species, fit jointly. This is the same as fitting
+    make_pooled_intercept_pooled_covariate_car_model to each species
+    separately, but the model is only compiled and tuned once.
+    """
+    data = _model_data(data, W)
+
+    with pm.Model(coords=_coords(data)) as model:
+        species_idx = pm.ConstantData("species_idx", data.species_idx, dims="obs_idx")
+        adj_idx = pm.ConstantData("adj_idx", data.cell_idx, dims="obs_idx")
+        X = pm.MutableData("X", data.covariates, dims=("adj_idx", "features_idx"))
+
+        alpha = pm.Beta("alpha", 5, 1, dims="species_idx")
+        tau_phi = pm.Gamma("tau_phi", 1, 1, dims="species_idx")
+        phi = sparse_car(
+            "phi",
+            data.adjacency,
+            alpha=alpha,
+            tau=tau_phi,
+            dims=("species_idx", "adj_idx"),
+        )
+        intercept = pm.Normal("intercept", mu=0, tau=1e-3, dims="species_idx")
+        betas = pm.Normal("betas", mu=0, tau=1e-3, dims=("species_idx", "features_idx"))
+        mu = pm.Deterministic(
+            "mu",
+            pm.math.exp(
+                intercept[species_idx]
+                + pm.math.sum(X[adj_idx] * betas[species_idx], axis=1)
+                + phi[species_idx, adj_idx]
+            ),
+            dims="obs_idx",
+        )
+        pm.Poisson(
+            "y",
+            mu=mu,
+            observed=_observed(data, fill_value=1e-3),
             dims="obs_idx",
         )
     return model
@@ -1,11 +1,21 @@
-from functools import partial
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 
+import cartopy
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
+import tqdm
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import Normalize
 
 from .geo import get_grid_meta
+from .profiling import span
 
 COLORMAP = "viridis"
 
@@ -21,6 +31,53 @@ def dataframe_color_getter(df, key_col, value_col, key, vmin=None, vmax=None):
         return (1, 1, 1, 0)
 
 
+@lru_cache
+def _stock_image():
+    """Read the background image used by `ax.stock_img` once per process."""
+    return plt.imread(
+        os.path.join(
+            cartopy.config["repo_data_dir"],
+            "raster",
+            "natural_earth",
+            "50-natural-earth-1-downsampled.png",
+        )
+    )
+
+
+def _add_stock_img(ax):
+    """Same as `ax.stock_img`, but reuses the image between plots."""
+    return ax.imshow(
+        _stock_image(),
+        origin="upper",
+        transform=ccrs.PlateCarree(),
+        extent=[-180, 180, -90, 90],
+    )
+
+
+def _grid_collection(grid, values, vmin, vmax, projection):
+    """Create a single collection for a grid, colored by the value of each key.
+    Keys without a value are transparent, like in dataframe_color_getter."""
+    keys = list(grid.keys())
+    array = np.array([values.get(key, np.nan) for key in keys], dtype=float)
+    vmin = vmin or np.nanmin(array)
+    vmax = vmax or np.nanmax(array)
+    cmap = plt.get_cmap(COLORMAP).copy()
+    cmap.set_bad((1, 1, 1, 0))
+    return PolyCollection(
+        [np.asarray(polygon.exterior.coords) for polygon in grid.values()],
+        array=np.ma.masked_invalid(array),
+        cmap=cmap,
+        norm=Normalize(vmin=vmin, vmax=vmax, clip=True),
+        edgecolor="face",
+        transform=projection,
+    )
+
+
+def _dataframe_values(df, key_col, value_col):
+    """Get a mapping from key to value, using the first row for each key."""
+    return df.drop_duplicates(key_col).set_index(key_col)[value_col]
+
+
 def plot_geometry(geometry, map_dims, **kwargs):
     xmin, xmax, ymin, ymax = map_dims
 
@@ -37,7 +94,7 @@ def plot_geometry(geometry, map_dims, **kwargs):
         edgecolor="k",
         facecolor=(1, 1, 1, 0),
     )
-    ax.stock_img()
+    _add_stock_img(ax)
     return fig, ax
 
 
@@ -59,7 +116,14 @@ def plot_grid(
     ax=None,
     projection=None,
     colorbar=True,
+    values=None,
 ):
+    """Plot a lattice of polygons over a map.
+
+    Cells are colored by `values`, a mapping from grid key to value, which draws
+    the whole lattice as a single collection. `color_callback` is the slower
+    alternative that returns the color of each cell from its key.
+    """
     xmin, xmax, ymin, ymax = map_dims
 
     # plot map with lattice of polygons
@@ -74,12 +138,15 @@ def plot_grid(
     if draw_gridline:
         ax.gridlines(draw_labels=True, dms=True, x_inline=False, y_inline=False)
 
-    for key, polygon in grid.items():
-        ax.add_feature(
-            cfeature.ShapelyFeature([polygon], projection),
-            # edgecolor="gray",
-            facecolor=color_callback(key) if color_callback else (1, 1, 1, 0),
-        )
+    if values is not None:
+        ax.add_collection(_grid_collection(grid, values, vmin, vmax, projection))
+    else:
+        for key, polygon in grid.items():
+            ax.add_feature(
+                cfeature.ShapelyFeature([polygon], projection),
+                # edgecolor="gray",
+                facecolor=color_callback(key) if color_callback else (1, 1, 1, 0),
+            )
 
     ax.add_feature(
         cfeature.ShapelyFeature([geometry], projection),
@@ -87,7 +154,7 @@ def plot_grid(
         facecolor=(1, 1, 1, 0),
     )
 
-    if color_callback and colorbar:
+    if (color_callback or values is not None) and colorbar:
         # some magic numbers for scaling: https://stackoverflow.com/a/26720422
         cbar = plt.colorbar(
             plt.matplotlib.cm.ScalarMappable(norm=None, cmap=COLORMAP),
@@ -102,7 +169,7 @@ def plot_grid(
                 for x in cbar.get_ticks()
             ]
         )
-    ax.stock_img()
+    _add_stock_img(ax)
 
 
 def plot_species(
@@ -129,9 +196,7 @@ def plot_species(
         grid_meta.geometry,
         grid_meta.extent,
         grid_meta.grid,
-        color_callback=partial(
-            dataframe_color_getter, sub_df, "grid_id", prop, vmin=vmin, vmax=vmax
-        ),
+        values=_dataframe_values(sub_df, "grid_id", prop),
         vmin=vmin,
         vmax=vmax,
         draw_gridline=False,
@@ -146,6 +211,14 @@ def plot_species(
     ax.set_title(title)
 
 
+def _ppc_mean(ppc):
+    """The mean of the posterior predictive for each observation, from either
+    the InferenceData or the summary from posterior_predictive_summary."""
+    if isinstance(ppc, pd.DataFrame):
+        return ppc["mean"].values
+    return ppc.posterior_predictive.y.mean(("chain", "draw")).values
+
+
 def plot_ppc_species(
     prep_df,
     ppc,
@@ -159,12 +232,11 @@ def plot_ppc_species(
     figsize=(5, 7),
     **kwargs,
 ):
-    pred_df = prep_df.copy()
-    shape = prep_df.shape
-    pred_df["pred"] = ppc.posterior_predictive.y.values.reshape(-1, shape[0]).mean(
-        axis=0
-    )
-    pred_df["log_pred"] = np.log(pred_df.pred)
+    pred_df = prep_df
+    if "pred" not in prep_df.columns:
+        pred_df = prep_df.copy()
+        pred_df["pred"] = _ppc_mean(ppc)
+        pred_df["log_pred"] = np.log(pred_df.pred)
     sub_df = pred_df[prep_df.primary_label == species]
 
     if show_hist:
@@ -184,9 +256,7 @@ def plot_ppc_species(
         grid_meta.geometry,
         grid_meta.extent,
         grid_meta.grid,
-        color_callback=partial(
-            dataframe_color_getter, sub_df, "grid_id", prop, vmin=vmin, vmax=vmax
-        ),
+        values=_dataframe_values(sub_df, "grid_id", prop),
         vmin=vmin,
         vmax=vmax,
         draw_gridline=False,
@@ -263,7 +333,7 @@ def plot_ppc_species_subplot(
 ):
 
     df = df.copy()
-    df["pred"] = ppc.posterior_predictive.y.values.reshape(-1, df.shape[0]).mean(axis=0)
+    df["pred"] = _ppc_mean(ppc)
     df["log_pred"] = np.log(df.pred)
 
     fig, axs = plt.subplots(
@@ -295,3 +365,60 @@ def plot_ppc_species_subplot(
     if subtitle:
         title += f" ({subtitle})"
     fig.suptitle(title)
+
+
+@dataclass
+class PlotJob:
+    """A map of values over the grid of a region, rendered to a file."""
+
+    path: str
+    region: str
+    grid_size: int
+    values: dict = field(repr=False)
+    title: str = None
+    vmin: float = None
+    vmax: float = None
+    figsize: tuple = (5, 5)
+
+
+def render_plot_job(job):
+    """Render a plot job and save it to its path."""
+    # the grid metadata is cached, so each process only loads a region once
+    grid_meta = get_grid_meta(job.region, job.grid_size)
+    with span("plot.plot_grid", path=os.path.basename(job.path)):
+        plot_grid(
+            grid_meta.geometry,
+            grid_meta.extent,
+            grid_meta.grid,
+            values=job.values,
+            vmin=job.vmin,
+            vmax=job.vmax,
+            draw_gridline=False,
+            figsize=job.figsize,
+        )
+        if job.title:
+            plt.title(job.title)
+        plt.tight_layout()
+    with span("plot.savefig", path=os.path.basename(job.path)):
+        plt.savefig(job.path)
+    plt.close("all")
+    return job.path
+
+
+def _init_render_worker():
+    matplotlib.use("Agg")
+
+
+def render_plot_jobs(jobs, processes=1, progress=False):
+    """Render a list of plot jobs across a pool of processes, using the
+    non-interactive Agg backend in each worker."""
+    jobs = list(jobs)
+    if processes == 1:
+        results = map(render_plot_job, jobs)
+        return list(tqdm.tqdm(results, total=len(jobs), disable=not progress))
+    with ProcessPoolExecutor(processes, initializer=_init_render_worker) as executor:
+        # group jobs by region so each worker reuses the same grid
+        jobs = sorted(jobs, key=lambda job: (job.region, job.grid_size))
+        chunksize = max(1, len(jobs) // (4 * (processes or os.cpu_count() or 1)))
+        results = executor.map(render_plot_job, jobs, chunksize=chunksize)
+        return list(tqdm.tqdm(results, total=len(jobs), disable=not progress))
@@ -0,0 +1,195 @@
+"""Time and measure the memory of the stages of a run.
+
+Stages are wrapped in `span` context managers, which do nothing unless
+profiling is enabled for the run. The profile path is passed through the
+environment, so worker processes append their spans to the same json lines
+file. At the end of a run the profile is converted into a chrome trace, which
+can be opened in chrome://tracing or https://ui.perfetto.dev, and summarized
+in a table.
+"""
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+PROFILE_ENV = "BIRDCALL_PROFILE"
+PROFILE_MEMORY_ENV = "BIRDCALL_PROFILE_MEMORY"
+
+# open spans in the current thread, for the peak memory of nested spans
+_local = threading.local()
+
+
+def enable_profiling(path, trace_memory=False):
+    """Start a new profile for this process and any processes it starts. With
+    trace_memory, the allocations of each span are traced with tracemalloc,
+    which slows the run down considerably."""
+    path = Path(path).resolve()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("")
+    os.environ[PROFILE_ENV] = str(path)
+    if trace_memory:
+        os.environ[PROFILE_MEMORY_ENV] = "1"
+    else:
+        os.environ.pop(PROFILE_MEMORY_ENV, None)
+
+
+def profiling_enabled():
+    return bool(os.environ.get(PROFILE_ENV))
+
+
+def _write(name, start_ns, duration_ns, attrs, memory=None):
+    record = dict(
+        name=name,
+        ts=start_ns // 1000,
+        dur=duration_ns // 1000,
+        pid=os.getpid(),
+        tid=threading.get_ident(),
+        depth=len(_stack()),
+        args=attrs,
+    )
+    if memory:
+        record["memory"] = memory
+    # a single write of a short line, so lines from concurrent processes are
+    # not interleaved
+    with open(os.environ[PROFILE_ENV], "a") as f:
+        f.write(json.dumps(record, default=str) + "\n")
+
+
+def record_span(name, start_ns, duration_ns, **attrs):
+    """Record a span that was timed elsewhere, from its start as nanoseconds
+    since the epoch and its duration in nanoseconds."""
+    if profiling_enabled():
+        _write(name, start_ns, duration_ns, attrs)
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def span(name, **attrs):
+    """Record the wall time of a block, and its allocations if memory tracing
+    is enabled. Extra keyword arguments are recorded with the span."""
+    if not profiling_enabled():
+        yield
+        return
+
+    trace_memory = os.environ.get(PROFILE_MEMORY_ENV) == "1"
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    stack = _stack()
+    entry = dict(peak=0)
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        # the peak is reset for this span, so keep the peak so far for the
+        # enclosing span
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        entry["start"] = current
+        tracemalloc.reset_peak()
+    stack.append(entry)
+    start_ts, start = time.time_ns(), time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter_ns() - start
+        stack.pop()
+        memory = None
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, entry["peak"])
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            memory = dict(
+                allocated=current - entry["start"], peak=peak - entry["start"]
+            )
+        _write(name, start_ts, duration, attrs, memory)
+
+
+def read_profile(path):
+    """Read the spans of a profile."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_chrome_trace(spans, path):
+    """Write spans in the chrome trace event format."""
+    events = [
+        dict(
+            name=s["name"],
+            ph="X",
+            ts=s["ts"],
+            dur=s["dur"],
+            pid=s["pid"],
+            tid=s["tid"],
+            args={**s["args"], **s.get("memory", {})},
+        )
+        for s in spans
+    ]
+    Path(path).write_text(json.dumps(dict(traceEvents=events)))
+
+
+def print_summary(spans):
+    """Print the count, total and mean wall time and the peak memory of each
+    stage, slowest first. The totals of nested stages overlap."""
+    stats = defaultdict(lambda: dict(count=0, total=0, peak=None))
+    for s in spans:
+        stat = stats[s["name"]]
+        stat["count"] += 1
+        stat["total"] += s["dur"] / 1e6
+        if "memory" in s:
+            stat["peak"] = max(stat["peak"] or 0, s["memory"]["peak"] / 1024**2)
+    print(f"{'stage':<36} {'count':>6} {'total s':>10} {'mean s':>10} {'peak mb':>8}")
+    for name, stat in sorted(stats.items(), key=lambda item: -item[1]["total"]):
+        peak = f"{stat['peak']:>8.1f}" if stat["peak"] is not None else f"{'':>8}"
+        print(
+            f"{name:<36} {stat['count']:>6} {stat['total']:>10.2f} "
+            f"{stat['total'] / stat['count']:>10.3f} {peak}"
+        )
+
+
+@contextmanager
+def profile_run(path, trace_memory=False):
+    """Profile a run if a path is given. Spans are written to the path as json
+    lines, and a chrome trace is written next to it with a .trace.json suffix
+    when the run is done. The environment is restored afterwards, so later runs
+    in the same process are not profiled."""
+    if not path:
+        yield
+        return
+    previous = {k: os.environ.get(k) for k in (PROFILE_ENV, PROFILE_MEMORY_ENV)}
+    enable_profiling(path, trace_memory=trace_memory)
+    try:
+        with span("run"):
+            yield
+    finally:
+        try:
+            spans = read_profile(path)
+            trace_path = Path(path).with_suffix(".trace.json")
+            write_chrome_trace(spans, trace_path)
+            print_summary(spans)
+            print(f"Wrote profile to {path} and {trace_path}")
+        finally:
+            for key, value in previous.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+
+def add_profile_args(parser):
+    """Add the profiling options to a command line parser."""
+    parser.add_argument(
+        "--profile", type=str, help="path to write a json lines profile of the run"
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="trace the allocations of each stage with tracemalloc",
+    )
@@ -0,0 +1,194 @@
+"""Sample the posterior of the models with one of several NUTS backends, or
+approximate it with variational inference."""
+import time
+
+import numpy as np
+import pandas as pd
+
+from birdcall_distribution.profiling import profiling_enabled, record_span
+from birdcall_distribution.utils import lazy_import
+
+# pymc is only imported when a model is sampled, so the commands start quickly
+pm = lazy_import("pymc")
+
+BACKENDS = ["pymc", "numpyro", "blackjax"]
+FIT_METHODS = ["nuts", "advi", "fullrank_advi", "pathfinder"]
+
+
+def compile_logp_dlogp(model=None):
+    """Compile the log-density and its gradient for NUTS. The compiled function
+    reads the mutable data of the model, so it can be reused with
+    sample_posterior after the data is changed with pm.set_data."""
+    model = pm.modelcontext(model)
+    return model.logp_dlogp_function(model.continuous_value_vars)
+
+
+class _TuningTimer:
+    """A callback for pm.sample that records how long each chain spends tuning
+    and drawing samples."""
+
+    def __init__(self):
+        self.times = {}
+
+    def __call__(self, trace, draw):
+        now = time.time_ns()
+        # the time of the first draw, the first draw after tuning, and the last
+        times = self.times.setdefault(draw.chain, [now, None, now])
+        if not draw.tuning and times[1] is None:
+            times[1] = now
+        times[2] = now
+
+    def record(self):
+        for chain, (start, tuned, end) in sorted(self.times.items()):
+            tuned = tuned or end
+            record_span("sampling.tune", start, tuned - start, chain=chain)
+            record_span("sampling.draw", tuned, end - tuned, chain=chain)
+
+
+def sample_posterior(
+    draws=1000,
+    tune=1000,
+    cores=4,
+    chains=None,
+    backend="pymc",
+    random_seed=None,
+    logp_dlogp_func=None,
+):
+    """Sample the posterior of the model in context with NUTS, and return the
+    InferenceData.
+
+    The jax backends need the optional `gpu` extra (and blackjax for the
+    blackjax backend). Their chains are vectorized, so every chain runs in a
+    single process instead of one process per core. The pymc backend uses the
+    function from compile_logp_dlogp if it is given, instead of compiling the
+    model again.
+    """
+    chains = chains or max(2, cores)
+    if backend == "pymc":
+        kwargs = {}
+        if logp_dlogp_func is not None:
+            kwargs["nuts"] = dict(logp_dlogp_func=logp_dlogp_func)
+        timer = _TuningTimer() if profiling_enabled() else None
+        trace = pm.sample(
+            draws,
+            tune=tune,
+            chains=chains,
+            cores=cores,
+            random_seed=random_seed,
+            callback=timer,
+            **kwargs,
+        )
+        if timer:
+            timer.record()
+        return trace
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    # importing jax is slow, so only do it when it's needed
+    from pymc import sampling_jax
+
+    sample = dict(
+        numpyro=sampling_jax.sample_numpyro_nuts,
+        blackjax=sampling_jax.sample_blackjax_nuts,
+    )[backend]
+    return sample(
+        draws=draws,
+        tune=tune,
+        chains=chains,
+        random_seed=random_seed,
+        chain_method="vectorized",
+    )
+
+
+def fit_posterior(draws=1000, method="nuts", iterations=30000, **kwargs):
+    """Fit the posterior of the model in context, and return draws from it as
+    InferenceData.
+
+    Besides NUTS, the posterior can be approximated with ADVI, full-rank ADVI
+    or pathfinder as a fast preview. Pathfinder needs pymc-experimental and
+    blackjax. The remaining keyword arguments are passed to sample_posterior.
+    """
+    random_seed = kwargs.get("random_seed")
+    if method == "nuts":
+        return sample_posterior(draws, **kwargs)
+    if method in ["advi", "fullrank_advi"]:
+        approx = pm.fit(iterations, method=method, random_seed=random_seed)
+        return approx.sample(draws, random_seed=random_seed)
+    if method == "pathfinder":
+        import pymc_experimental as pmx
+
+        return pmx.fit(method="pathfinder", num_draws=draws, random_seed=random_seed)
+    raise ValueError(f"Unknown fit method: {method}")
+
+
+def posterior_predictive_summary(
+    trace,
+    var_name="y",
+    chunk_size=500,
+    quantiles=(0.05, 0.5, 0.95),
+    max_quantile_draws=1000,
+    random_seed=None,
+    return_draws=False,
+):
+    """Summarize the posterior predictive of the model in context per
+    observation, without keeping every draw in memory.
+
+    Predictive draws are generated for chunks of posterior draws at a time. The
+    mean and variance are merged across chunks exactly, while the quantiles are
+    computed from an evenly thinned subset of at most max_quantile_draws draws.
+    Returns a dataframe with a row per observation, and the full posterior
+    predictive as InferenceData if return_draws is set.
+    """
+    posterior = trace.posterior
+    n_chains, n_draws = posterior.sizes["chain"], posterior.sizes["draw"]
+    starts = range(0, n_draws, chunk_size)
+    seeds = np.random.SeedSequence(random_seed).generate_state(len(starts))
+    # keep every nth draw for the quantiles
+    step = int(np.ceil(n_chains * n_draws / max_quantile_draws))
+
+    count, mean, m2 = 0, 0.0, 0.0
+    thinned, chunks = [], []
+    for start, seed in zip(starts, seeds):
+        draws = pm.sample_posterior_predictive(
+            posterior.isel(draw=slice(start, start + chunk_size)),
+            var_names=[var_name],
+            random_seed=int(seed),
+            progressbar=False,
+            return_inferencedata=False,
+        )[var_name]
+        if return_draws:
+            chunks.append(draws)
+        x = draws.reshape(-1, draws.shape[-1]).astype(float)
+
+        # merge the moments of the chunk with the running moments
+        n = x.shape[0]
+        chunk_mean = x.mean(axis=0)
+        delta = chunk_mean - mean
+        m2 = (
+            m2
+            + ((x - chunk_mean) ** 2).sum(axis=0)
+            + delta**2 * count * n / (count + n)
+        )
+        mean = mean + delta * n / (count + n)
+        count += n
+
+        # the index of each row in the chain-major order of all the draws
+        index = (
+            np.arange(n_chains)[:, None] * n_draws
+            + np.arange(start, start + draws.shape[1])[None, :]
+        ).ravel()
+        thinned.append(x[index % step == 0])
+
+    summary = pd.DataFrame(dict(mean=mean, var=m2 / count))
+    summary.index.name = "obs_idx"
+    q = np.quantile(np.concatenate(thinned), quantiles, axis=0)
+    for quantile, values in zip(quantiles, q):
+        summary[f"q{quantile * 100:g}"] = values
+
+    if not return_draws:
+        return summary
+    ppc = pm.to_inference_data(
+        posterior_predictive={var_name: np.concatenate(chunks, axis=1)},
+        model=pm.modelcontext(None),
+    )
+    return summary, ppc
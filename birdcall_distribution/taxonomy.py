@@ -0,0 +1,169 @@
+"""Map eBird species codes to their common names.
+
+The eBird taxonomy is read once, from the copy in the kaggle dataset or from
+the bucket, and cached as a json dictionary of species codes to common names.
+Later runs read the cache instead, so the mapping can be built without network
+access. The cache records the version of the taxonomy, and a different version
+is only used when the requested one cannot be read.
+"""
+import json
+import os
+import warnings
+from pathlib import Path
+
+TAXONOMY_VERSION = "2021"
+TAXONOMY_URL = (
+    "https://storage.googleapis.com/birdclef-eda-f22/data/raw/birdclef-2022/"
+    "eBird_Taxonomy_v{version}.csv"
+)
+TAXONOMY_LOCAL_PATH = "data/raw/birdclef-2022/eBird_Taxonomy_v{version}.csv"
+# bump this when the layout of the cached taxonomy changes
+TAXONOMY_CACHE_VERSION = 1
+TAXONOMY_CACHE_DIR = Path(
+    os.environ.get(
+        "BIRDCALL_TAXONOMY_CACHE",
+        Path.home() / ".cache" / "birdcall_distribution" / "taxonomy",
+    )
+)
+
+
+def taxonomy_cache_path(version=TAXONOMY_VERSION, cache_dir=None):
+    """Get the path to the cached taxonomy for a version."""
+    return Path(cache_dir or TAXONOMY_CACHE_DIR) / f"ebird_taxonomy_v{version}.json"
+
+
+def read_taxonomy_csv(source):
+    """Read the common name of each species code from an eBird taxonomy csv at
+    a path or url."""
+    import pandas as pd
+
+    df = pd.read_csv(source)
+    df.columns = df.columns.str.lower()
+    return df.set_index("species_code")["primary_com_name"].to_dict()
+
+
+def read_taxonomy_cache(path):
+    """Read a cached taxonomy, or None if it is missing or in an older layout."""
+    path = Path(path)
+    if not path.exists():
+        return None
+    cached = json.loads(path.read_text())
+    if cached.get("cache_version") != TAXONOMY_CACHE_VERSION:
+        return None
+    return cached
+
+
+def _write_json(path, data, **kwargs):
+    """Write json to a temporary file and move it into place, so concurrent
+    readers never see a partially written file."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(data, **kwargs))
+    os.replace(tmp_path, path)
+
+
+def write_taxonomy_cache(path, names, version, source):
+    """Cache a taxonomy."""
+    _write_json(
+        path,
+        dict(
+            cache_version=TAXONOMY_CACHE_VERSION,
+            version=version,
+            source=str(source),
+            names=names,
+        ),
+    )
+
+
+def load_taxonomy(version=TAXONOMY_VERSION, source=None, cache_dir=None, offline=False):
+    """Get the common name of each species code, from the cached taxonomy of the
+    version if there is one, unless a source is given while online. Otherwise it is
+    read from the source, by default the kaggle dataset or the bucket, and cached.
+    If it cannot be read, or offline is set, the newest cached version is used."""
+    cache_dir = Path(cache_dir or TAXONOMY_CACHE_DIR)
+    path = taxonomy_cache_path(version, cache_dir)
+    cached = read_taxonomy_cache(path)
+    # an explicit source refreshes the cache, unless it can't be read anyway
+    if (
+        cached is not None
+        and cached["version"] == version
+        and (source is None or offline)
+    ):
+        return cached["names"]
+
+    if source is None:
+        local_path = Path(TAXONOMY_LOCAL_PATH.format(version=version))
+        source = local_path if local_path.exists() else None
+    source = source or TAXONOMY_URL.format(version=version)
+    error = None
+    if not offline:
+        try:
+            names = read_taxonomy_csv(source)
+        except (OSError, ValueError, KeyError) as e:
+            error = e
+        else:
+            write_taxonomy_cache(path, names, version, source)
+            return names
+
+    # fall back to the newest version in the cache
+    fallbacks = [
+        read_taxonomy_cache(p) for p in cache_dir.glob("ebird_taxonomy_v*.json")
+    ]
+    fallbacks = sorted(
+        (c for c in fallbacks if c is not None), key=lambda c: c["version"]
+    )
+    if not fallbacks:
+        reason = "" if offline else f", and it could not be read from {source}"
+        raise RuntimeError(
+            f"There is no cached eBird taxonomy in {cache_dir}{reason}"
+        ) from error
+    fallback = fallbacks[-1]
+    if fallback["version"] != version:
+        reason = "is not cached" if offline else f"could not be read from {source}"
+        warnings.warn(
+            f"Using the cached eBird taxonomy v{fallback['version']} instead of "
+            f"v{version}, which {reason}"
+        )
+    return fallback["names"]
+
+
+def update_species_mapping(mapping, species, **kwargs):
+    """Get the common names of a set of species, reusing the names in an
+    existing mapping. The taxonomy is only loaded if there are species that are
+    not in the mapping yet. Returns the mapping and the species that were
+    added. Keyword arguments are passed to load_taxonomy."""
+    missing = set(species) - set(mapping)
+    names = load_taxonomy(**kwargs) if missing else {}
+    unknown = sorted(s for s in missing if s not in names)
+    if unknown:
+        warnings.warn(f"Species not in the eBird taxonomy: {', '.join(unknown)}")
+    updated = {
+        s: mapping[s] if s in mapping else names[s]
+        for s in sorted(species)
+        if s in mapping or s in names
+    }
+    return updated, sorted(set(updated) - set(mapping))
+
+
+def write_species_mapping(path, species, **kwargs):
+    """Update the species mapping at a path with the common names of any new
+    species, and drop species that are no longer listed. The mapping is only
+    rewritten if it changed. Returns the species that were added."""
+    path = Path(path)
+    mapping = json.loads(path.read_text()) if path.exists() else {}
+    updated, added = update_species_mapping(mapping, species, **kwargs)
+    if updated != mapping:
+        _write_json(path, updated, indent=2)
+    return added
+
+
+def add_taxonomy_args(parser):
+    """Add the options for loading the eBird taxonomy to a parser."""
+    parser.add_argument(
+        "--taxonomy", type=str, help="Path or url of the eBird taxonomy csv"
+    )
+    parser.add_argument("--taxonomy-version", type=str, default=TAXONOMY_VERSION)
+    parser.add_argument(
+        "--offline", action="store_true", help="only use the cached taxonomy"
+    )
@@ -0,0 +1,199 @@
+"""Render XYZ map tiles of the per-cell predictions of a model.
+
+The cells of a grid form a regular lattice in longitude and latitude, so the
+cell under each pixel of a web mercator tile can be found with a table lookup
+instead of drawing polygons. Tiles are rendered as png images, or as geojson
+with the cells that overlap the tile and their values.
+"""
+import io
+import json
+import math
+from functools import lru_cache
+from pathlib import Path
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from .export import read_columnar
+from .geo import get_grid_meta
+from .plot import COLORMAP
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.0511287798
+
+
+def tile_bounds(z, x, y):
+    """Get the (west, south, east, north) bounds of a tile in degrees."""
+    n = 2**z
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return (x / n * 360 - 180, south, (x + 1) / n * 360 - 180, north)
+
+
+def lonlat_to_tile(lon, lat, z):
+    """Get the tile that contains a point."""
+    n = 2**z
+    lat = math.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def tiles_for_bounds(bounds, z):
+    """Get every tile at a zoom level that overlaps a (west, south, east, north)
+    bounding box."""
+    west, south, east, north = bounds
+    x0, y0 = lonlat_to_tile(west, north, z)
+    x1, y1 = lonlat_to_tile(east, south, z)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def _pixel_lonlat(z, x, y, size=TILE_SIZE):
+    """Get the longitude and latitude at the center of each pixel of a tile."""
+    n = 2**z
+    offsets = (np.arange(size) + 0.5) / size
+    lon = (x + offsets) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    return lon, lat
+
+
+def load_predictions(path):
+    """Read the per-cell predictions in a directory of model assets, from the
+    columnar export if there is one or from the ppc json otherwise. Returns a
+    dataframe with a row per cell, and the region and grid size."""
+    path = Path(path)
+    columnar = list(path.glob("ppc_*.bin"))
+    if columnar:
+        columns, metadata = read_columnar(columnar[0])
+        df = pd.DataFrame(columns)
+        df.insert(0, "grid_id", metadata["grid_id"])
+        return df, metadata["region"], metadata["grid_size"]
+    df = pd.read_json(list(path.glob("ppc_*.json"))[0], orient="records")
+    return df, df.region.iloc[0], int(df.grid_size.iloc[0])
+
+
+class TileRenderer:
+    """Render tiles for the values of the cells of a grid. Rendered tiles are
+    kept in an LRU cache of cache_size tiles."""
+
+    def __init__(self, grid_meta, values, vmin=None, vmax=None, cache_size=1024):
+        if grid_meta.indices is None:
+            raise ValueError("Tiles can only be rendered for a regular lattice")
+        self.keys = list(grid_meta.grid.keys())
+        self.values = np.array(
+            [values.get(key, np.nan) for key in self.keys], dtype=float
+        )
+        self.values[~np.isfinite(self.values)] = np.nan
+        self.vmin = np.nanmin(self.values) if vmin is None else vmin
+        self.vmax = np.nanmax(self.values) if vmax is None else vmax
+
+        # the position of each cell in the lattice, and the reverse lookup
+        self.cell_bounds = np.array([p.bounds for p in grid_meta.grid.values()])
+        self.origin = self.cell_bounds[:, :2].min(axis=0)
+        self.cell_size = self.cell_bounds[0, 2:] - self.cell_bounds[0, :2]
+        cols, rows = grid_meta.indices.T
+        self.table = np.full((cols.max() + 1, rows.max() + 1), -1)
+        self.table[cols, rows] = np.arange(len(self.keys))
+        self.bounds = (*self.origin, *self.cell_bounds[:, 2:].max(axis=0))
+
+        cmap = plt.get_cmap(COLORMAP).copy()
+        cmap.set_bad((1, 1, 1, 0))
+        self.cmap = cmap
+        self.png = lru_cache(maxsize=cache_size)(self._png)
+        self.geojson = lru_cache(maxsize=cache_size)(self._geojson)
+
+    @classmethod
+    def from_assets(cls, path, value="log_pred", **kwargs):
+        """Create a renderer for a column of the predictions in a directory of
+        model assets."""
+        df, region, grid_size = load_predictions(path)
+        grid_meta = get_grid_meta(region, grid_size)
+        return cls(grid_meta, df.set_index("grid_id")[value], **kwargs)
+
+    def cell_index(self, lon, lat):
+        """Get the index of the cell at each point, or -1 outside the grid."""
+        col = np.floor((lon - self.origin[0]) / self.cell_size[0]).astype(int)
+        row = np.floor((lat - self.origin[1]) / self.cell_size[1]).astype(int)
+        valid = (
+            (col >= 0)
+            & (col < self.table.shape[0])
+            & (row >= 0)
+            & (row < self.table.shape[1])
+        )
+        return np.where(valid, self.table[col * valid, row * valid], -1)
+
+    def render(self, z, x, y):
+        """Render a tile as an array of rgba bytes."""
+        lon, lat = _pixel_lonlat(z, x, y)
+        idx = self.cell_index(lon[None, :], lat[:, None])
+        values = np.where(idx >= 0, self.values[idx], np.nan)
+        scaled = (values - self.vmin) / ((self.vmax - self.vmin) or 1)
+        return self.cmap(np.ma.masked_invalid(np.clip(scaled, 0, 1)), bytes=True)
+
+    def _png(self, z, x, y):
+        """Render a tile as a png, or None if there are no cells in it."""
+        rgba = self.render(z, x, y)
+        if not rgba[..., 3].any():
+            return None
+        buf = io.BytesIO()
+        plt.imsave(buf, rgba, format="png")
+        return buf.getvalue()
+
+    def _geojson(self, z, x, y):
+        """Get the cells that overlap a tile and their values as geojson."""
+        west, south, east, north = tile_bounds(z, x, y)
+        minx, miny, maxx, maxy = self.cell_bounds.T
+        overlaps = (minx < east) & (maxx > west) & (miny < north) & (maxy > south)
+        features = [
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [
+                        [
+                            [minx[i], miny[i]],
+                            [maxx[i], miny[i]],
+                            [maxx[i], maxy[i]],
+                            [minx[i], maxy[i]],
+                            [minx[i], miny[i]],
+                        ]
+                    ],
+                },
+                "properties": {
+                    "grid_id": self.keys[i],
+                    "value": None if np.isnan(self.values[i]) else self.values[i],
+                },
+            }
+            for i in np.flatnonzero(overlaps)
+        ]
+        return json.dumps({"type": "FeatureCollection", "features": features})
+
+    def write_pyramid(self, output, min_zoom=0, max_zoom=6):
+        """Write every non-empty png tile between two zoom levels, along with a
+        tiles.json that describes them. Returns the number of tiles written."""
+        output = Path(output)
+        n_tiles = 0
+        for z in range(min_zoom, max_zoom + 1):
+            for x, y in tiles_for_bounds(self.bounds, z):
+                data = self._png(z, x, y)
+                if data is None:
+                    continue
+                path = output / str(z) / str(x) / f"{y}.png"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data)
+                n_tiles += 1
+        (output / "tiles.json").write_text(
+            json.dumps(
+                dict(
+                    tiles="{z}/{x}/{y}.png",
+                    minzoom=min_zoom,
+                    maxzoom=max_zoom,
+                    bounds=[float(b) for b in self.bounds],
+                    vmin=float(self.vmin),
+                    vmax=float(self.vmax),
+                    colormap=COLORMAP,
+                )
+            )
+        )
+        return n_tiles
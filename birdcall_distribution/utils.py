@@ -1,3 +1,8 @@
+import importlib.util
+import sys
+from types import ModuleType
+
+
 def convert_time(ts: str) -> float:
     """Convert hh:mm strings into hours since midnight."""
     try:
@@ -6,3 +11,37 @@ def convert_time(ts: str) -> float:
     except:
         # xx:xx
         return float("nan")
+
+
+class _MissingModule(ModuleType):
+    """Stands in for a module that is not installed, and raises
+    ModuleNotFoundError when it is used."""
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        raise ModuleNotFoundError(
+            f"No module named {self.__name__!r}", name=self.__name__
+        )
+
+
+def lazy_import(name):
+    """Import a module the first time one of its attributes is used, so the
+    commands can start without loading heavy dependencies like pymc. Parent
+    packages are still imported right away. If the module is not installed,
+    ModuleNotFoundError is raised when it is first used."""
+    if name in sys.modules:
+        return sys.modules[name]
+    try:
+        spec = importlib.util.find_spec(name)
+    except ModuleNotFoundError:
+        # a parent package is not installed
+        spec = None
+    if spec is None:
+        return _MissingModule(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
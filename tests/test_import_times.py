@@ -0,0 +1,21 @@
+"""Keep the commands fast to start, see birdcall_distribution.commands.import_times.
+
+Set BIRDCALL_IMPORT_BUDGET_FACTOR to scale the budgets on a slow machine.
+"""
+import os
+
+import pytest
+
+from birdcall_distribution.commands.import_times import BUDGETS, check_budget
+
+FACTOR = float(os.environ.get("BIRDCALL_IMPORT_BUDGET_FACTOR", 1.0))
+
+
+@pytest.mark.parametrize("module", list(BUDGETS))
+def test_import_budget(module):
+    result = check_budget(module, factor=FACTOR, repeat=3)
+    assert not result["imported"], f"{module} imports {result['imported']}"
+    assert result["seconds"] <= result["budget"], (
+        f"{module} took {result['seconds']:.3f} s to import, "
+        f"over its budget of {result['budget']:.2f} s"
+    )